@@ -33,7 +33,17 @@ __status__ = "Done"
 
 import argparse
 import sys
+import os
 import json
+import mmap
+import struct
+import hashlib
+from bisect import bisect_left
+from array import array
+from multiprocessing import Pool
+
+# how much of the file to look at at once when scanning
+BLOCK_SIZE = 4 * 1024 * 1024
 
 ###############################################################################
 ###############################################################################
@@ -63,6 +73,431 @@ class ContigParser:
                 yield header, "".join(seq)
             break
 
+    def scanFasta(self, fp, blockSize=BLOCK_SIZE, stats=False): # this is a generator function
+        """Yield (header, length, offset, lineBases, lineWidth, gcCount, nCount) without building any sequences
+
+        The GC and N counts are only filled in (case insensitive) if stats is set.
+        """
+        scanner = FastaScanner(stats=stats)
+        while True:
+            block = fp.read(blockSize)
+            if not block:
+                break
+            scanner.feed(block)
+            for record in scanner.records:
+                yield record
+            scanner.records = []
+        scanner.finish()
+        for record in scanner.records:
+            yield record
+
+    def readLengths(self, fp): # this is a generator function
+        """Like readFasta but yields (header, length)"""
+        for record in self.scanFasta(fp):
+            yield record[0], record[1]
+
+class FastaScanner:
+    """Measures contigs a block at a time, keeping track of what it needs for a .fai"""
+    def __init__(self, offset=0, stats=False):
+        self.offset = offset        # file offset of the next block fed in
+        self.stats = stats          # count GC and Ns as well
+        self.inHeader = False
+        self.headerParts = []
+        self.lineStart = True
+        self.current = None         # [header, length, offset, lineBases, lineWidth]
+        self.firstLine = 0          # how much of the first line of sequence we've seen
+        self.records = []           # finished contigs, the caller empties this
+
+    def feed(self, buf):
+        i = 0
+        n = len(buf)
+        while i < n:
+            if self.inHeader:
+                nl = buf.find('\n', i)
+                if nl == -1:
+                    self.headerParts.append(buf[i:])
+                    break
+                self.headerParts.append(buf[i:nl])
+                self._startContig(self.offset + nl + 1)
+                i = nl + 1
+                self.lineStart = True
+                continue
+            # sequence runs up to the next '>' at the start of a line
+            if self.lineStart and buf[i] == '>':
+                k = i
+            else:
+                k = buf.find('\n>', i)
+                k = n if k == -1 else k + 1
+            if k > i:
+                self._addSequence(buf, i, k)
+                self.lineStart = (buf[k-1] == '\n')
+            if k < n:
+                self._endContig()
+                self.inHeader = True
+                i = k + 1
+            else:
+                i = k
+        self.offset += n
+
+    def finish(self):
+        if self.inHeader:
+            self._startContig(self.offset)
+        self._endContig()
+
+    def _startContig(self, offset):
+        header = "".join(self.headerParts).rstrip().partition(" ")[0]
+        self.current = [header, 0, offset, None, None, 0, 0]
+        self.headerParts = []
+        self.inHeader = False
+        self.firstLine = 0
+
+    def _addSequence(self, buf, i, k):
+        current = self.current
+        if current is None:
+            # no header yet, readFasta would have fallen over here anyway
+            return
+        current[1] += (k - i) - buf.count('\n', i, k) - buf.count('\r', i, k)
+        if current[4] is None:
+            nl = buf.find('\n', i, k)
+            if nl == -1:
+                self.firstLine += k - i
+            else:
+                current[4] = self.firstLine + nl - i + 1
+                current[3] = current[4] - (2 if nl > i and buf[nl-1] == '\r' else 1)
+        if self.stats:
+            current[5] += buf.count('G', i, k) + buf.count('C', i, k) + buf.count('g', i, k) + buf.count('c', i, k)
+            current[6] += buf.count('N', i, k) + buf.count('n', i, k)
+
+    def _endContig(self):
+        current = self.current
+        if current is not None:
+            if current[4] is None:
+                # no newline after the sequence
+                current[3] = current[1]
+                current[4] = current[1] + 1
+            self.records.append(tuple(current))
+        self.current = None
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def chunkBoundaries(mm, numChunks):
+    """Split a mapped fasta into about numChunks pieces that each start on a header"""
+    size = len(mm)
+    boundaries = [0]
+    for i in range(1, numChunks):
+        start = mm.find('\n>', max(size * i // numChunks, boundaries[-1], 1) - 1)
+        if start == -1:
+            break
+        if start + 1 > boundaries[-1]:
+            boundaries.append(start + 1)
+    boundaries.append(size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+def scanChunk(work):
+    """Scan [start, end) of a fasta, run in a worker process"""
+    (contigFile, start, end, blockSize, stats) = work
+    with open(contigFile, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            scanner = FastaScanner(start, stats)
+            for block_start in xrange(start, end, blockSize):
+                scanner.feed(mm[block_start:min(block_start + blockSize, end)])
+            scanner.finish()
+        finally:
+            mm.close()
+    return scanner.records
+
+def scanFastaParallel(contigFile, processes, blockSize=BLOCK_SIZE, stats=False): # this is a generator function
+    """scanFasta on several processes, records come back in file order"""
+    if os.path.getsize(contigFile) == 0:
+        return
+    with open(contigFile, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # a few chunks per process so one slow chunk doesn't hold everyone up
+            chunks = chunkBoundaries(mm, processes * 4)
+        finally:
+            mm.close()
+    pool = Pool(processes)
+    try:
+        for records in pool.imap(scanChunk, [(contigFile, start, end, blockSize, stats) for (start, end) in chunks]):
+            for record in records:
+                yield record
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def faiFileName(contigFile):
+    return contigFile + ".fai"
+
+def faiIsCurrent(contigFile):
+    """True if there's a .fai at least as new as the contig file"""
+    fai_file = faiFileName(contigFile)
+    return os.path.isfile(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(contigFile)
+
+def readFai(faiFile): # this is a generator function
+    """Yield (header, length) from a samtools style .fai"""
+    with open(faiFile, "r") as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            yield fields[0], int(fields[1])
+
+# header, length, offset, lineBases, lineWidth
+FAI_LINE = "%s\t%d\t%d\t%d\t%d\n"
+
+def teeFai(records, faiFile): # this is a generator function
+    """Pass records through, writing them to faiFile on the way
+
+    samtools leaves zero length contigs out of a .fai so they are dropped here
+    too, that way the output is the same whether the .fai was read or written.
+    """
+    # only put the .fai in place once it is complete
+    with open(faiFile + ".tmp", "w") as fh:
+        for record in records:
+            if record[1] == 0:
+                continue
+            fh.write(FAI_LINE % record[:5])
+            yield record
+    os.rename(faiFile + ".tmp", faiFile)
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def gcFraction(length, gcCount, nCount):
+    """GC as a fraction of the non N bases, same as makeKmerGCCSV.pl"""
+    if length > nCount:
+        return float(gcCount) / (length - nCount)
+    return 0.
+
+def assemblyStats(lengths):
+    """Number of contigs, total length, N50 and L50"""
+    lengths = sorted(lengths, reverse=True)
+    total = sum(lengths)
+    n50 = 0
+    l50 = 0
+    so_far = 0
+    for length in lengths:
+        so_far += length
+        l50 += 1
+        if 2 * so_far >= total:
+            n50 = length
+            break
+    return { "contigs" : len(lengths), "total_length" : total, "n50" : n50, "l50" : l50 }
+
+def writeStatsTSV(fh, records):
+    """One line per contig then the assembly stats as # lines, returns the assembly stats"""
+    lengths = array('L')
+    fh.write("contig\tlength\tgc\tn_count\n")
+    for record in records:
+        fh.write("%s\t%d\t%.6f\t%d\n" % (record[0], record[1], gcFraction(record[1], record[5], record[6]), record[6]))
+        lengths.append(record[1])
+    assembly = assemblyStats(lengths)
+    for key in ["contigs", "total_length", "n50", "l50"]:
+        fh.write("# %s\t%d\n" % (key, assembly[key]))
+    return assembly
+
+def writeStatsNDJSON(fh, records):
+    """One JSON object per contig per line, then one for the assembly"""
+    lengths = array('L')
+    for record in records:
+        fh.write('{"contig": %s, "length": %d, "gc": %.6f, "n_count": %d}\n' % (json.dumps(record[0]), record[1], gcFraction(record[1], record[5], record[6]), record[6]))
+        lengths.append(record[1])
+    assembly = assemblyStats(lengths)
+    fh.write('{"assembly": %s}\n' % json.dumps(assembly, sort_keys=True))
+    return assembly
+
+def writeStatsJSON(fh, records):
+    """{"contigs": {header: {"length", "gc", "n_count"}, ...}, "assembly": {...}}, written as we go"""
+    lengths = array('L')
+    fh.write('{"contigs": {')
+    separator = ''
+    for record in records:
+        fh.write('%s%s: {"length": %d, "gc": %.6f, "n_count": %d}' % (separator, json.dumps(record[0]), record[1], gcFraction(record[1], record[5], record[6]), record[6]))
+        separator = ', '
+        lengths.append(record[1])
+    assembly = assemblyStats(lengths)
+    fh.write('}, "assembly": %s}' % json.dumps(assembly, sort_keys=True))
+    return assembly
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def writeLengthsJSON(fh, records):
+    """The same {header: length} object json.dumps would make, written as we go (in file order)"""
+    fh.write('{')
+    separator = ''
+    for record in records:
+        fh.write('%s%s: %d' % (separator, json.dumps(record[0]), record[1]))
+        separator = ', '
+    fh.write('}')
+
+def writeLengthsNDJSON(fh, records):
+    for record in records:
+        fh.write('{"contig": %s, "length": %d}\n' % (json.dumps(record[0]), record[1]))
+
+def writeLengthsTSV(fh, records):
+    for record in records:
+        fh.write("%s\t%d\n" % (record[0], record[1]))
+
+# binary lengths file, all little endian:
+#
+#   magic (8 bytes) | number of contigs N (uint64)
+#   N lengths (uint32) in name order
+#   N + 1 offsets (uint64) into the names
+#   the names, sorted and run together
+#   N indices (uint32) into the sorted names giving the order they were in the file
+#
+LENGTHS_MAGIC = 'CLENS001'
+
+def writeLengthsBinary(fh, records):
+    """Sorted names + uint32 lengths that ContigLengths can mmap, the last of any repeated header wins"""
+    contig_lens = {}
+    file_order = []
+    for record in records:
+        if record[0] not in contig_lens:
+            file_order.append(record[0])
+        contig_lens[record[0]] = record[1]
+    names = sorted(contig_lens)
+    fh.write(LENGTHS_MAGIC)
+    fh.write(struct.pack('<Q', len(names)))
+    lengths = array('I', [contig_lens[name] for name in names])
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+    lengths.tofile(fh)
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    for i in xrange(0, len(offsets), 65536):
+        chunk = offsets[i:i+65536]
+        fh.write(struct.pack('<%dQ' % len(chunk), *chunk))
+    for name in names:
+        fh.write(name)
+    rank = dict(zip(names, xrange(len(names))))
+    order = array('I', [rank[name] for name in file_order])
+    if sys.byteorder != 'little':
+        order.byteswap()
+    order.tofile(fh)
+
+class ContigLengths:
+    """Read only dict like view of a binary lengths file, names are found by binary search over the mmap"""
+    def __init__(self, fileName):
+        self.fh = open(fileName, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:8] != LENGTHS_MAGIC:
+            raise ValueError("%s is not a contig lengths file" % fileName)
+        (self.size,) = struct.unpack_from('<Q', self.mm, 8)
+        self.lengthsStart = 16
+        self.offsetsStart = self.lengthsStart + 4 * self.size
+        self.namesStart = self.offsetsStart + 8 * (self.size + 1)
+        (names_size,) = struct.unpack_from('<Q', self.mm, self.namesStart - 8)
+        self.orderStart = self.namesStart + names_size
+        # files written before the order was kept stop at the names
+        self.hasOrder = len(self.mm) >= self.orderStart + 4 * self.size
+
+    def __len__(self):
+        return self.size
+
+    def name(self, i):
+        (start, end) = struct.unpack_from('<QQ', self.mm, self.offsetsStart + 8 * i)
+        return self.mm[self.namesStart + start:self.namesStart + end]
+
+    def length(self, i):
+        return struct.unpack_from('<I', self.mm, self.lengthsStart + 4 * i)[0]
+
+    def index(self, name):
+        """Position of name in the file or -1"""
+        i = bisect_left(self, name)
+        if i < self.size and self.name(i) == name:
+            return i
+        return -1
+
+    def __getitem__(self, i):
+        # bisect wants a sequence of names
+        return self.name(i)
+
+    def get(self, name, default=None):
+        i = self.index(name)
+        if i == -1:
+            return default
+        return self.length(i)
+
+    def __contains__(self, name):
+        return self.index(name) != -1
+
+    def iteritems(self):
+        for i in xrange(self.size):
+            yield self.name(i), self.length(i)
+
+    def iterFileOrder(self):
+        """Like iteritems but in the order the contigs were in the fasta (if the file knows it)"""
+        if not self.hasOrder:
+            for item in self.iteritems():
+                yield item
+            return
+        for i in xrange(self.size):
+            (j,) = struct.unpack_from('<I', self.mm, self.orderStart + 4 * i)
+            yield self.name(j), self.length(j)
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# lengths are cached as binary lengths files keyed on where the contig file is,
+# how big it is and when it was last changed
+CACHE_DIR = os.environ.get("CLENS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cLens"))
+
+def cacheFileName(contigFile, cacheDir=None):
+    stats = os.stat(contigFile)
+    # the 2 is for lengths files that keep the file order
+    key = "%s\t%d\t%r\t2" % (os.path.realpath(contigFile), stats.st_size, stats.st_mtime)
+    return os.path.join(cacheDir or CACHE_DIR, hashlib.sha1(key).hexdigest() + ".bin")
+
+def cachedLengths(contigFile, cacheDir=None, processes=1):
+    """ContigLengths for contigFile, scanning it into the cache first if this version isn't there"""
+    cache_file = cacheFileName(contigFile, cacheDir)
+    if not os.path.isfile(cache_file):
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # someone else beat us to it
+                if not os.path.isdir(cache_dir):
+                    raise
+        if processes > 1:
+            records = scanFastaParallel(contigFile, processes)
+        else:
+            records = ContigParser().scanFasta(open(contigFile, "rb"))
+        # write then rename so nobody sees half a file
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        with open(tmp_file, "wb") as fh:
+            writeLengthsBinary(fh, records)
+        os.rename(tmp_file, cache_file)
+    return ContigLengths(cache_file)
+
+def getContigLengths(contigFile, cacheDir=None, processes=1):
+    """{header: length} for contigFile, straight from the cache if we've seen this version before"""
+    lengths = cachedLengths(contigFile, cacheDir, processes)
+    try:
+        return dict(lengths.iteritems())
+    finally:
+        lengths.close()
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -72,23 +507,37 @@ def doWork( args ):
     """ Main wrapper"""
 
     # parse conting file
-    contig_lens = {}
     try:
-        with open(args.contigFile, "r") as fh:
-            CP = ContigParser()
-            for header, seq in CP.readFasta(fh):
-               contig_lens[header] = len(seq)
+        if args.cache:
+            records = cachedLengths(args.contigFile, args.cache_dir, args.processes).iterFileOrder()
+        elif args.fai and not args.stats and faiIsCurrent(args.contigFile):
+            records = readFai(faiFileName(args.contigFile))
+        else:
+            if args.processes > 1:
+                records = scanFastaParallel(args.contigFile, args.processes, stats=args.stats)
+            else:
+                records = ContigParser().scanFasta(open(args.contigFile, "rb"), stats=args.stats)
+            if args.fai:
+                records = teeFai(records, faiFileName(args.contigFile))
     except:
         print "Error opening file:", args.contigFile, sys.exc_info()[0]
         raise
 
+    # the contig file gets read as the output is written
     try:
-        with open(args.outFile, "w") as fh:
-            fh.write(json.dumps(contig_lens))
+        with open(args.outFile, "wb") as fh:
+            if args.stats:
+                assembly = STATS_WRITERS[args.format](fh, records)
+                print "%d contigs, %d bp, N50 %d, L50 %d" % (assembly["contigs"], assembly["total_length"], assembly["n50"], assembly["l50"])
+            else:
+                LENGTHS_WRITERS[args.format](fh, records)
     except:
-        print "Error opening file:", args.outFile, sys.exc_info()[0]
+        print "Error writing file:", args.outFile, sys.exc_info()[0]
         raise
 
+LENGTHS_WRITERS = { "json" : writeLengthsJSON, "ndjson" : writeLengthsNDJSON, "tsv" : writeLengthsTSV, "binary" : writeLengthsBinary }
+STATS_WRITERS = { "json" : writeStatsJSON, "ndjson" : writeStatsNDJSON, "tsv" : writeStatsTSV }
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -99,9 +548,19 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('contigFile', help="File containing contgs")
     parser.add_argument('outFile', help="File to write to")
+    parser.add_argument('-p', '--processes', type=int, default=1, help="scan the contig file in chunks on this many processes [default: 1]")
+    parser.add_argument('-s', '--stats', action="store_true", default=False, help="write length, GC fraction and N count for each contig plus the N50 and L50 instead of just lengths")
+    parser.add_argument('-t', '--format', choices=["json", "ndjson", "tsv", "binary"], default="json", help="output format, binary is sorted names and lengths for ContigLengths to mmap (not with --stats) [default: json]")
+    parser.add_argument('-c', '--cache', action="store_true", default=False, help="keep lengths in a cache keyed on path, size and mtime and use them next time")
+    parser.add_argument('--cache_dir', default=None, help="where to keep the cache [default: $CLENS_CACHE_DIR or ~/.cache/cLens]")
+    parser.add_argument('-f', '--fai', action="store_true", default=False, help="read lengths from contigFile.fai if it is up to date, otherwise write one (like samtools, zero length contigs are left out)")
 
     # parse the arguments
     args = parser.parse_args()
+    if args.stats and args.format not in STATS_WRITERS:
+        parser.error("--stats can't be written as " + args.format)
+    if args.stats and args.cache:
+        parser.error("--cache only keeps lengths, it can't be used with --stats")
 
     # do what we came here to do
     doWork(args)
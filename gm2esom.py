@@ -20,6 +20,9 @@
 #
 # *PLUS* yr esom names file
 #
+# Give it several 'gmbin' files and you get a class file for each one
+# (bins.txt -> bins.cls) from a single read of the names file.
+#
 #
 # Produces an ESOM class file which looks like:
 #
@@ -75,9 +78,12 @@ __status__ = "Development"
 import argparse
 import sys
 import os
-from colorsys import hsv_to_rgb as htr
+import json
 import numpy as np
 
+# how much of the names file to work on at a time
+BLOCK_SIZE = 4 * 1024 * 1024
+
 ###############################################################################
 ###############################################################################
 ###############################################################################
@@ -90,67 +96,329 @@ import numpy as np
 ###############################################################################
 ###############################################################################
 
-def doWork( args ):
-    """ Main wrapper"""
-    
-    esom_name_to_ids = []
-    num_esom_names = 0
-    all_named_contigs = {}
-    # parse names file and make the hash we'll be needing
-    try:
-        with open(args.names, "r") as fh:
-            for line in fh:
-                num_esom_names += 1
-                parts = line.rstrip().split("\t")
-                cid_parts = parts[1].split('_')
-                if 'leftover' in cid_parts:
-                    base_name = "_".join(cid_parts[:len(cid_parts)-2])
-                else:
-                    base_name = "_".join(cid_parts[:len(cid_parts)-1])
-                esom_name_to_ids.append((base_name, parts)) # ('hydrocarbon_scaffold_82282', ['1', 'hydrocarbon_scaffold_82282_0']) 
-                all_named_contigs[base_name] = True
-    except: 
-        print "Error opening file:", args.names, sys.exc_info()[0]
-        raise    
+def esomBaseName(cid):
+    """hydrocarbon_scaffold_82282_0 -> hydrocarbon_scaffold_82282 (and ..._leftover_1 -> ...)"""
+    if 'leftover' not in cid:
+        return cid.rpartition('_')[0]
+    cid_parts = cid.split('_')
+    if 'leftover' in cid_parts:
+        return "_".join(cid_parts[:len(cid_parts)-2])
+    return "_".join(cid_parts[:len(cid_parts)-1])
+
+def countLines(fileName, blockSize=BLOCK_SIZE):
+    """Number of lines in a file without holding onto any of them"""
+    num_lines = 0
+    last = '\n'
+    with open(fileName, "rb") as fh:
+        while True:
+            block = fh.read(blockSize)
+            if not block:
+                break
+            num_lines += block.count('\n')
+            last = block[-1]
+    if last != '\n':
+        # no newline on the last line
+        num_lines += 1
+    return num_lines
+
+def readEsomNames(fileName, blockSize=BLOCK_SIZE): # this is a generator function
+    """Yield lists of contig base names, one per line of the names file, a block at a time"""
+    with open(fileName, "rb") as fh:
+        leftover = ''
+        while True:
+            block = fh.read(blockSize)
+            if not block:
+                if leftover:
+                    yield [esomBaseName(cidFromNamesLine(leftover))]
+                break
+            lines = (leftover + block).split('\n')
+            leftover = lines.pop()
+            yield [esomBaseName(cidFromNamesLine(line)) for line in lines]
 
-    # parse the GM file
+def cidFromNamesLine(line):
+    # the contig id is the second column ('1\thydrocarbon_scaffold_82282_0\t...')
+    fields = line.split("\t", 2)
+    if len(fields) > 2:
+        return fields[1]
+    return fields[1].rstrip()
+
+def readGmBins(fileName):
+    """Parse groopm print -f minimal output into ({cid : bin id}, sorted bin ids)"""
     gm_bin_ids = {}
     cid_2_gmbin = {}
-    try:
-        with open(args.gmbin, "r") as fh:
-            for line in fh:
-                parts = line.rstrip().split("\t")
-                bid = int(parts[0])
-                cid_2_gmbin[parts[1]] = bid 
-                gm_bin_ids[bid] = True                 
-    except: 
-        print "Error opening file:", args.names, sys.exc_info()[0]
-        raise    
+    with open(fileName, "r") as fh:
+        for line in fh:
+            parts = line.rstrip().split("\t")
+            bid = int(parts[0])
+            cid_2_gmbin[parts[1]] = bid
+            gm_bin_ids[bid] = True
+    return (cid_2_gmbin, sorted(gm_bin_ids))
 
-    num_gm_bins = len(gm_bin_ids.keys())
+def hsvToRgb(h, s, v):
+    """colorsys.hsv_to_rgb over whole arrays, returns an (n, 3) array in [0, 1]"""
+    h = np.asarray(h, dtype=float)
+    s = np.broadcast_to(np.asarray(s, dtype=float), h.shape)
+    v = np.broadcast_to(np.asarray(v, dtype=float), h.shape)
+    i = np.floor(h * 6.0).astype(int)
+    f = h * 6.0 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i % 6
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+    return np.column_stack((r, g, b))
 
-    # produce a whole heap of colors
-    color_steps = [float(i)/num_gm_bins for i in range(num_gm_bins)]
+def binColours(numBins):
+    """Evenly spaced hues, one per bin"""
     S = 1       # SAT and VAL remain fixed at 1. Reduce to make
     V = 1       # Pastels if that's your preference...
-    raw_cols = np.array([np.array(htr(val, S, V))*255 for val in color_steps])
-    bin_cols = [[int(i) for i in j] for j in raw_cols]
+    return (hsvToRgb(np.arange(numBins, dtype=float) / max(numBins, 1), S, V) * 255).astype(int).tolist()
 
-    # work out all the bin 0 contigs
-    for cid in all_named_contigs:
-        if cid not in cid_2_gmbin:
-            cid_2_gmbin[cid] = 0
-    
-    # build the class file
-    print "%d" % num_esom_names + "%"
-    print "0%\tNOCLASS\t255\t255\t255"
-    for i in range(len(bin_cols)):
-        print "%d" % (i+1) + "%" + "\t%d\t%d\t%d\t%d" % (i+1, bin_cols[i][0],bin_cols[i][1],bin_cols[i][2])
+# 1 / golden ratio, stepping the hue by this keeps neighbouring bins far apart
+GOLDEN = (5 ** 0.5 - 1) / 2
+
+def goldenColours(binIds):
+    """A colour for each bin id that only depends on the id
+
+    Hues go round by the golden ratio and saturation / value cycle through a few
+    levels so bins that land on similar hues still look different.
+    """
+    ids = np.asarray(binIds, dtype=float)
+    h = (ids * GOLDEN) % 1.0
+    s = 1.0 - 0.15 * ((ids // 2) % 3)
+    v = 1.0 - 0.25 * (ids % 2)
+    return (hsvToRgb(h, s, v) * 255).astype(int).tolist()
+
+def paletteColours(binIds, palette="golden", cacheFile=None):
+    """Colours for each of binIds, reusing (and adding to) any colours saved in cacheFile
+
+    The cache remembers which palette it was made with, asking for another one is a ValueError.
+    """
+    cache = { "palette" : palette, "colours" : {} }
+    if cacheFile is not None and os.path.isfile(cacheFile):
+        with open(cacheFile, "r") as fh:
+            cache = json.load(fh)
+        if cache.get("palette") != palette:
+            raise ValueError("%s holds %s colours, not %s ones" % (cacheFile, cache.get("palette"), palette))
+    colours = cache["colours"]
+    missing = [bid for bid in binIds if str(bid) not in colours]
+    if missing:
+        # only make colours for the new bins, all in one go
+        if palette == "golden":
+            new_colours = goldenColours(missing)
+        else:
+            # evenly spaced hues depend on how many bins there are
+            even = dict(zip(binIds, binColours(len(binIds))))
+            new_colours = [even[bid] for bid in missing]
+        for (bid, colour) in zip(missing, new_colours):
+            colours[str(bid)] = colour
+        if cacheFile is not None:
+            with open(cacheFile + ".tmp", "w") as fh:
+                json.dump(cache, fh, sort_keys=True)
+            os.rename(cacheFile + ".tmp", cacheFile)
+    return [colours[str(bid)] for bid in binIds]
+
+def writeClassHeader(out, numRows, binIds, binCols):
+    out.write("%d%%\n" % numRows)
+    out.write("0%\tNOCLASS\t255\t255\t255\n")
+    for (bid, colour) in zip(binIds, binCols):
+        out.write("%d%%\t%d\t%d\t%d\t%d\n" % (bid, bid, colour[0], colour[1], colour[2]))
+
+def writeClassRows(out, firstRow, bids):
+    """Write '<row>\t<bin id>' lines for consecutive rows with one format and one write"""
+    rows = np.empty(2 * len(bids), dtype=np.int64)
+    rows[0::2] = np.arange(firstRow, firstRow + len(bids))
+    rows[1::2] = bids
+    out.write(("%d\t%d\n" * len(bids)) % tuple(rows.tolist()))
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# Incremental updates
+#
+# The row index remembers which rows of the names file belong to each contig
+# as runs of [first row, number of rows] so a re-bin only has to touch the
+# rows of contigs that moved.
+
+def indexFileName(namesFile):
+    return namesFile + ".gm2esom.idx"
+
+def buildRowIndex(namesFile):
+    """{base name : [[first row, number of rows], ...]} and the number of rows in namesFile"""
+    runs = {}
+    row = 1
+    last_name = None
+    for base_names in readEsomNames(namesFile):
+        for base_name in base_names:
+            if base_name == last_name:
+                last_run[1] += 1
+            else:
+                last_run = [row, 1]
+                runs.setdefault(base_name, []).append(last_run)
+                last_name = base_name
+            row += 1
+    return (runs, row - 1)
+
+def loadRowIndex(namesFile, indexFile=None):
+    """The row index for namesFile, (re)built and saved if it's missing or out of date"""
+    if indexFile is None:
+        indexFile = indexFileName(namesFile)
+    stats = os.stat(namesFile)
+    try:
+        with open(indexFile, "r") as fh:
+            index = json.load(fh)
+        if index["names_size"] == stats.st_size and index["names_mtime"] == stats.st_mtime:
+            return (index["runs"], index["num_rows"])
+    except (IOError, ValueError, KeyError):
+        pass
+    (runs, num_rows) = buildRowIndex(namesFile)
+    with open(indexFile + ".tmp", "w") as fh:
+        json.dump({ "names_size" : stats.st_size, "names_mtime" : stats.st_mtime, "num_rows" : num_rows, "runs" : runs }, fh)
+    os.rename(indexFile + ".tmp", indexFile)
+    return (runs, num_rows)
+
+def changedRows(oldBins, newBins, runs):
+    """Sorted [(row, new bin id), ...] for every row whose contig changed bins"""
+    changes = []
+    for cid in set(oldBins) | set(newBins):
+        bid = newBins.get(cid, 0)
+        if oldBins.get(cid, 0) != bid:
+            for (first_row, num_rows) in runs.get(cid, []):
+                changes.extend((row, bid) for row in xrange(first_row, first_row + num_rows))
+    changes.sort()
+    return changes
+
+def updateClassFile(prevClassFile, out, numRows, binIds, binCols, changes, blockSize=BLOCK_SIZE):
+    """Copy prevClassFile to out with a new header and the changed rows swapped in
+
+    Blocks without any changed rows are copied as is.
+    """
+    with open(prevClassFile, "rb") as fh:
+        prev_rows = int(fh.readline().rstrip().rstrip('%'))
+        if prev_rows != numRows:
+            raise ValueError("%s has %d rows but the names file has %d" % (prevClassFile, prev_rows, numRows))
+        # skip the old classes
+        while True:
+            pos = fh.tell()
+            line = fh.readline()
+            if '%' not in line:
+                fh.seek(pos)
+                break
+        writeClassHeader(out, numRows, binIds, binCols)
+        row = 1             # row of the first line in the block
+        next_change = 0
+        leftover = ''
+        while True:
+            block = fh.read(blockSize)
+            buf = leftover + block
+            if block:
+                cut = buf.rfind('\n') + 1
+                (buf, leftover) = (buf[:cut], buf[cut:])
+            num_lines = buf.count('\n') + (0 if block or buf.endswith('\n') or not buf else 1)
+            if next_change < len(changes) and changes[next_change][0] < row + num_lines:
+                lines = buf.split('\n')
+                while next_change < len(changes) and changes[next_change][0] < row + num_lines:
+                    (change_row, bid) = changes[next_change]
+                    lines[change_row - row] = "%d\t%d" % (change_row, bid)
+                    next_change += 1
+                buf = '\n'.join(lines)
+            out.write(buf)
+            row += num_lines
+            if not block:
+                break
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+def classFileName(gmbinFile, outDir=None):
+    """Where the class file for gmbinFile goes when there's more than one: bins.txt -> bins.cls"""
+    if outDir is None:
+        return os.path.splitext(gmbinFile)[0] + ".cls"
+    return os.path.join(outDir, os.path.splitext(os.path.basename(gmbinFile))[0] + ".cls")
+
+def doWork( args ):
+    """ Main wrapper"""
+
+    # the class file starts with the number of rows so count them before streaming
+    try:
+        if args.update is not None:
+            (runs, num_esom_names) = loadRowIndex(args.names, args.index)
+        else:
+            num_esom_names = countLines(args.names)
+    except:
+        print "Error opening file:", args.names, sys.exc_info()[0]
+        raise
+
+    # parse the GM files, anything not in one is in bin 0
+    bin_sets = []
+    for gmbin in args.gmbin:
+        try:
+            (cid_2_gmbin, bin_ids) = readGmBins(gmbin)
+        except:
+            print "Error opening file:", gmbin, sys.exc_info()[0]
+            raise
+
+        # produce a whole heap of colors
+        try:
+            bin_cols = paletteColours(bin_ids, args.palette, args.colour_cache)
+        except ValueError as e:
+            print "Error:", e
+            sys.exit(1)
+        except:
+            print "Error opening file:", args.colour_cache, sys.exc_info()[0]
+            raise
+
+        # work out where it goes
+        if len(args.gmbin) > 1:
+            out_file = classFileName(gmbin, args.out_dir)
+        else:
+            out_file = args.out
+        if out_file is None:
+            out = sys.stdout
+        else:
+            # write somewhere else first in case we're updating the class file in place
+            out = open(out_file + ".tmp", "w", 1024 * 1024)
+        bin_sets.append((cid_2_gmbin, bin_ids, bin_cols, out, out_file))
 
-    for i in range(len(esom_name_to_ids)):
-        # ('hydrocarbon_scaffold_82282', ['1', 'hydrocarbon_scaffold_82282_0']) 
-        gm_bid = cid_2_gmbin[esom_name_to_ids[i][0]]
-        print "%d\t%d" % (i+1,gm_bid)
+    # build the class files
+    if args.update is not None:
+        (cid_2_gmbin, bin_ids, bin_cols, out, out_file) = bin_sets[0]
+        try:
+            (old_cid_2_gmbin, old_bin_ids) = readGmBins(args.old_gmbin)
+        except:
+            print "Error opening file:", args.old_gmbin, sys.exc_info()[0]
+            raise
+        changes = changedRows(old_cid_2_gmbin, cid_2_gmbin, runs)
+        try:
+            updateClassFile(args.update, out, num_esom_names, bin_ids, bin_cols, changes)
+        except:
+            print "Error opening file:", args.update, sys.exc_info()[0]
+            raise
+        sys.stderr.write("%d rows changed bins\n" % len(changes))
+    else:
+        for (cid_2_gmbin, bin_ids, bin_cols, out, out_file) in bin_sets:
+            writeClassHeader(out, num_esom_names, bin_ids, bin_cols)
+        row = 1
+        try:
+            # one pass over the names file for all the bin sets
+            for base_names in readEsomNames(args.names):
+                defaults = [0] * len(base_names)
+                for (cid_2_gmbin, bin_ids, bin_cols, out, out_file) in bin_sets:
+                    writeClassRows(out, row, map(cid_2_gmbin.get, base_names, defaults))
+                row += len(base_names)
+        except:
+            print "Error opening file:", args.names, sys.exc_info()[0]
+            raise
+    for (cid_2_gmbin, bin_ids, bin_cols, out, out_file) in bin_sets:
+        if out is not sys.stdout:
+            out.close()
+            os.rename(out_file + ".tmp", out_file)
 
 ###############################################################################
 ###############################################################################
@@ -160,11 +428,22 @@ def doWork( args ):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('gmbin', help="output of groopm print")
+    parser.add_argument('gmbin', nargs='+', help="output of groopm print, give several to make a class file for each (bins.txt -> bins.cls)")
     parser.add_argument('names', help="esom names file")
+    parser.add_argument('-o', '--out', default=None, help="write the class file here instead of to stdout (one gmbin only)")
+    parser.add_argument('-d', '--out_dir', default=None, help="put the class files for several gmbins here [default: next to each gmbin]")
+    parser.add_argument('-p', '--palette', choices=["golden", "even"], default="golden", help="golden: colours step round the hue wheel by the golden ratio so neighbouring bins stand apart and a bin keeps its colour whatever the bin count, even: evenly spaced hues (the old colours) [default: golden]")
+    parser.add_argument('-c', '--colour_cache', default=None, help="JSON file of bin id -> colour (for one --palette), bins in here keep their colour and new bins get added")
+    parser.add_argument('-u', '--update', default=None, help="previous class file to update, only the rows of contigs that changed bins are redone")
+    parser.add_argument('-g', '--old_gmbin', default=None, help="the groopm print output the --update class file was made from")
+    parser.add_argument('-i', '--index', default=None, help="where to keep the names file row index for --update [default: <names>.gm2esom.idx]")
     
     # parse the arguments
     args = parser.parse_args()        
+    if args.update is not None and args.old_gmbin is None:
+        parser.error("--update needs --old_gmbin")
+    if len(args.gmbin) > 1 and (args.out is not None or args.update is not None):
+        parser.error("--out and --update only work with one gmbin")
 
     # do what we came here to do
     doWork(args)
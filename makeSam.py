@@ -4,6 +4,9 @@ import os
 from optparse import OptionParser
 import sys
 import tempfile
+import hashlib
+import shutil
+import fcntl
 ###############################################################################
 #
 #    makesam.py
@@ -26,8 +29,11 @@ import tempfile
 ###############################################################################
 
 
-def mkindex(database, algorithm):
-    subprocess.check_call('bwa index -a '+ algorithm+' '+ database, shell=True)
+def mkindex(database, algorithm, prefix=None):
+    if prefix is None:
+        subprocess.check_call('bwa index -a '+ algorithm+' '+ database, shell=True)
+    else:
+        subprocess.check_call('bwa index -a '+ algorithm+' -p '+ prefix+' '+ database, shell=True)
 
 def aln(database, readfile, outfile, threads):
     subprocess.check_call('bwa aln -t '+ threads+' '+ database+' '+ readfile+' >'+outfile, shell=True)
@@ -112,6 +118,102 @@ def checkForDatabase(database_basename):
     else:
       return False
 
+# BWA index cache
+#
+# Indices live in <cache>/<sha1 of the reference>-<algorithm>/ref.* so any run
+# against the same sequence (wherever the file is) can reuse them. Every run
+# holds a shared lock on <entry>.lock from before it looks for the entry until
+# it is done mapping, so runs never wait on each other and nobody can evict the
+# entry from under them. Builds happen in a temp dir that gets renamed into
+# place while holding <entry>.build so only one run builds each entry. Entries
+# are evicted least recently used first once the cache goes over quota, but only
+# when nobody holds their lock.
+#
+INDEX_CACHE = os.environ.get('MAKESAM_INDEX_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'makeSam'))
+
+def referenceHash(database):
+    sha = hashlib.sha1()
+    with open(database, 'rb') as fh:
+        while True:
+            block = fh.read(4 * 1024 * 1024)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+def dirSize(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+def evictIndices(cacheDir, quota, keep):
+    """Remove least recently used indices until the cache is under quota bytes"""
+    if quota is None or quota <= 0:
+        return
+    entries = []
+    for name in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, name)
+        if os.path.isdir(path) and '.tmp.' not in name:
+            entries.append((os.path.getmtime(path), dirSize(path), path))
+    total = sum(entry[1] for entry in entries)
+    for (last_used, size, path) in sorted(entries):
+        if total <= quota:
+            break
+        if path == keep:
+            continue
+        lock = open(path + '.lock', 'a')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # someone is using it
+                continue
+            sys.stderr.write('evicting cached indices '+path+"\n")
+            shutil.rmtree(path, True)
+            total -= size
+        finally:
+            lock.close()
+
+def cachedIndex(database, algorithm, cacheDir, quota):
+    """Returns (prefix of a bwa index for database, lock to close when done), building it if need be"""
+    if not os.path.isdir(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            if not os.path.isdir(cacheDir):
+                raise
+    key = referenceHash(database)+'-'+algorithm
+    entry = os.path.join(cacheDir, key)
+    prefix = os.path.join(entry, 'ref')
+    lock = open(entry + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        if os.path.isdir(entry):
+            sys.stderr.write('using cached indices '+entry+"\n")
+        else:
+            # one builder at a time, everyone else waits and then uses what it made
+            build_lock = open(entry + '.build', 'a')
+            try:
+                fcntl.flock(build_lock, fcntl.LOCK_EX)
+                if os.path.isdir(entry):
+                    sys.stderr.write('using cached indices '+entry+"\n")
+                else:
+                    sys.stderr.write('making indices in '+entry+"\n")
+                    tmp_dir = tempfile.mkdtemp(prefix=key+'.tmp.', dir=cacheDir)
+                    try:
+                        mkindex(database, algorithm, os.path.join(tmp_dir, 'ref'))
+                        os.rename(tmp_dir, entry)
+                    except:
+                        shutil.rmtree(tmp_dir, True)
+                        raise
+            finally:
+                build_lock.close()
+        # mark it as recently used
+        os.utime(entry, None)
+    except:
+        lock.close()
+        raise
+    evictIndices(cacheDir, quota, entry)
+    return (prefix, lock)
+
 # Entry sub. Parse vars and call parseSamBam
 #
 if __name__ == '__main__':
@@ -141,6 +243,12 @@ if __name__ == '__main__':
             default=None, help="The amount of memory to use where possible (default 2GB*number of threads)")
     parser.add_option("--bwa-aln", action="store_true", dest="use_aln",
             default=False, help="Use 'bwa aln' to perform alignment (the default is bwa mem)")
+    parser.add_option("-C", "--index_cache", type="string", dest="indexCache",
+            default=INDEX_CACHE, help="Where to keep bwa indices between runs, keyed on the reference's contents [default: $MAKESAM_INDEX_CACHE or ~/.cache/makeSam]")
+    parser.add_option("-Q", "--index_cache_quota", type="float", dest="indexCacheQuota",
+            default=100, help="Evict the least recently used cached indices when the cache gets bigger than this many GB, 0 for no limit [default: 100]")
+    parser.add_option("--no_index_cache", action="store_true", dest="noIndexCache",
+            default=False, help="Build the indices next to the database like -k/--keep and -K/--kept do, instead of using the index cache")
 
     # get and check options
     (opts, args) = parser.parse_args()
@@ -163,7 +271,10 @@ if __name__ == '__main__':
             parser.print_help()
             sys.exit(1)
 
-    if(opts.keptfiles is None and checkForDatabase(opts.database)):
+    # the cache is used unless the indices are wanted next to the database
+    useIndexCache = (opts.keptfiles is None and opts.keepfiles is None and not opts.noIndexCache)
+
+    if(not useIndexCache and opts.keptfiles is None and checkForDatabase(opts.database)):
         sys.stderr.write("You didn't specify --kept but there appears to be bwa index files present. I'm cowardly refusing to run so as not to risk overwriting")
         sys.exit(1)
 
@@ -174,7 +285,11 @@ if __name__ == '__main__':
         algorithm = opts.algorithm
 
     # create indexes if required
-    if(opts.keptfiles is None):
+    database = opts.database
+    indexLock = None
+    if(useIndexCache):
+        (database, indexLock) = cachedIndex(opts.database, algorithm, opts.indexCache, opts.indexCacheQuota * 1024 ** 3)
+    elif(opts.keptfiles is None):
         sys.stderr.write('making indices'+"\n")
         sys.stderr.flush
         mkindex(opts.database, algorithm)
@@ -206,27 +321,27 @@ if __name__ == '__main__':
       sai2 = tempfile.mkstemp(suffix='.sai')
       if(opts.longReads):
           if bam_output_file is None:
-              bwasw(opts.database, opts.readfile_1,opts.readfile_2,
+              bwasw(database, opts.readfile_1,opts.readfile_2,
                       output_file, opts.threads)
           else:
-              bwasw_to_sorted_indexed_bam(opts.database,
+              bwasw_to_sorted_indexed_bam(database,
                       opts.readfile_1,opts.readfile_2, bam_output_file,
                       opts.threads)
       else:
-          aln(opts.database, opts.readfile_1, sai1[1], numThreads)
+          aln(database, opts.readfile_1, sai1[1], numThreads)
           if(doSings is False):
-              aln(opts.database, opts.readfile_2, sai2[1], numThreads)
+              aln(database, opts.readfile_2, sai2[1], numThreads)
               if bam_output_file is None:
-                  sampe(opts.database, sai1[1], sai2[1], opts.readfile_1, opts.readfile_2,
+                  sampe(database, sai1[1], sai2[1], opts.readfile_1, opts.readfile_2,
                         output_file)
               else:
-                  sampe_to_sorted_indexed_bam(opts.database, sai1[1], sai2[1], opts.readfile_1, opts.readfile_2,
+                  sampe_to_sorted_indexed_bam(database, sai1[1], sai2[1], opts.readfile_1, opts.readfile_2,
                         bam_output_file, numThreads, maxMemory)
           else:
               if bam_output_file is None:
-                  samse(opts.database, sai1[1], opts.readfile_1, output_file)
+                  samse(database, sai1[1], opts.readfile_1, output_file)
               else:
-                  samse_to_sorted_indexed_bam(opts.database, sai1[1], opts.readfile_1, bam_output_file, numThreads, maxMemory)
+                  samse_to_sorted_indexed_bam(database, sai1[1], opts.readfile_1, bam_output_file, numThreads, maxMemory)
       safeRemove(sai1[1])
       safeRemove(sai2[1])
     else:
@@ -235,13 +350,15 @@ if __name__ == '__main__':
         sys.stderr.write("Sorry, sam output file format for bwa-mem is not supported at this time (though it relatively easy to implement)\n")
         success = False
       elif (opts.singleEnd is True):
-        mem_single_to_sorted_indexed_bam(opts.database, opts.readfile_1, bam_output_file, numThreads, maxMemory)
+        mem_single_to_sorted_indexed_bam(database, opts.readfile_1, bam_output_file, numThreads, maxMemory)
       else:
-        mem_to_sorted_indexed_bam(opts.database, opts.readfile_1, opts.readfile_2, bam_output_file, numThreads, maxMemory)
+        mem_to_sorted_indexed_bam(database, opts.readfile_1, opts.readfile_2, bam_output_file, numThreads, maxMemory)
 
 
     # clean up
-    if(opts.keepfiles is None and opts.keptfiles is None):
+    if(indexLock is not None):
+        indexLock.close()
+    if(not useIndexCache and opts.keepfiles is None and opts.keptfiles is None):
         safeRemove(opts.database+'.amb')
         safeRemove(opts.database+'.ann')
         safeRemove(opts.database+'.bwt')
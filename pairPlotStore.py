@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import numpy as np
+import os
+import json
+import struct
+###############################################################################
+#
+#    pairPlotStore.py
+#    Read and write the consolidated pair plot store made by sam2PairPlotCSV.py
+#    Copyright (C) 2010 Adam Skarshewski, Michael Imelfort
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+# Kept apart from sam2PairPlotCSV.py so plotting a store doesn't need pysam
+###############################################################################
+# Consolidated pair plot store
+###############################################################################
+#
+# One binary file instead of three .csv files per contig:
+#
+#   PPSTORE1                    magic
+#   <column data>               raw little endian arrays, one after the other
+#   <index>                     JSON: { "contigs" : [con_id, ...],
+#                                       "entries" : { con_id : { column : [offset, count], "mode_coverage" : x,
+#                                                                "coverage_start" : position of the first coverage value } } }
+#   <index offset> PPSTORE1     8 byte little endian offset of the index, magic again
+#
+# Columns are position (int32), insertsize (int32), direction (int8) and coverage (int32)
+#
+STORE_MAGIC = 'PPSTORE1'
+STORE_COLUMNS = { 'position' : '<i4', 'insertsize' : '<i4', 'direction' : '<i1', 'coverage' : '<i4' }
+
+class PairPlotStoreWriter:
+    """Write pair and coverage data for every contig into one consolidated file"""
+    def __init__(self, storePath):
+        self.storePath = storePath
+        self.fh = open(storePath, 'wb')
+        self.fh.write(STORE_MAGIC)
+        self.index = { 'contigs' : [], 'entries' : {} }
+
+    def contigEntry(self, con_id):
+        entries = self.index['entries']
+        if con_id not in entries:
+            self.index['contigs'].append(con_id)
+            entries[con_id] = {}
+        return entries[con_id]
+
+    def writeColumn(self, con_id, column, values):
+        values = np.asarray(values, dtype=STORE_COLUMNS[column])
+        self.contigEntry(con_id)[column] = [self.fh.tell(), len(values)]
+        self.fh.write(values.tostring())
+
+    def writePairs(self, con_id, positions, inserts, codes):
+        self.writeColumn(con_id, 'position', positions)
+        self.writeColumn(con_id, 'insertsize', inserts)
+        self.writeColumn(con_id, 'direction', codes)
+
+    def writeCoverage(self, con_id, coverage, mode_coverage, firstPosition=1):
+        self.writeColumn(con_id, 'coverage', coverage)
+        self.contigEntry(con_id)['mode_coverage'] = int(mode_coverage)
+        self.contigEntry(con_id)['coverage_start'] = int(firstPosition)
+
+    def close(self):
+        index_offset = self.fh.tell()
+        self.fh.write(json.dumps(self.index))
+        self.fh.write(struct.pack('<Q', index_offset))
+        self.fh.write(STORE_MAGIC)
+        self.fh.close()
+
+class PairPlotStoreReader:
+    """Random access to the contigs in a consolidated pair plot store"""
+    def __init__(self, storePath):
+        self.storePath = storePath
+        self.fh = open(storePath, 'rb')
+        if(self.fh.read(len(STORE_MAGIC)) != STORE_MAGIC):
+            raise IOError("Not a pair plot store: " + storePath)
+        self.fh.seek(-(8 + len(STORE_MAGIC)), os.SEEK_END)
+        index_end = self.fh.tell()
+        (index_offset,) = struct.unpack('<Q', self.fh.read(8))
+        if(self.fh.read(len(STORE_MAGIC)) != STORE_MAGIC):
+            raise IOError("Pair plot store is truncated: " + storePath)
+        self.fh.seek(index_offset)
+        self.index = json.loads(self.fh.read(index_end - index_offset))
+
+    def contigs(self):
+        return list(self.index['contigs'])
+
+    def hasContig(self, con_id):
+        return con_id in self.index['entries']
+
+    def contigEntry(self, con_id):
+        return self.index['entries'][con_id]
+
+    def loadColumn(self, con_id, column):
+        entry = self.contigEntry(con_id)
+        if column not in entry:
+            return None
+        (offset, count) = entry[column]
+        self.fh.seek(offset)
+        return np.fromfile(self.fh, dtype=STORE_COLUMNS[column], count=count)
+
+    def loadPairs(self, con_id):
+        """Returns: (position, insertsize, direction) arrays sorted by position"""
+        return (self.loadColumn(con_id, 'position'), self.loadColumn(con_id, 'insertsize'), self.loadColumn(con_id, 'direction'))
+
+    def loadCoverage(self, con_id):
+        """Returns: (coverage, mode_coverage) or (None, None) if there is no coverage for this contig"""
+        return (self.loadColumn(con_id, 'coverage'), self.contigEntry(con_id).get('mode_coverage'))
+
+    def coverageStart(self, con_id):
+        """The (1 based) position of the first coverage value"""
+        return self.contigEntry(con_id).get('coverage_start', 1)
+
+    def close(self):
+        self.fh.close()
+
+#
+# Copy the contigs from a bunch of stores into a single one in the given order
+#
+def mergePairPlotStores(storePath, partPaths, contig_order):
+    parts = [PairPlotStoreReader(part_path) for part_path in partPaths]
+    where = {}
+    for part in parts:
+        for con_id in part.contigs():
+            where[con_id] = part
+
+    writer = PairPlotStoreWriter(storePath)
+    for con_id in contig_order:
+        if con_id not in where:
+            continue
+        part = where[con_id]
+        for column in ('coverage', 'position', 'insertsize', 'direction'):
+            values = part.loadColumn(con_id, column)
+            if values is not None:
+                writer.writeColumn(con_id, column, values)
+        for (key, value) in part.contigEntry(con_id).iteritems():
+            if key not in STORE_COLUMNS:
+                writer.contigEntry(con_id)[key] = value
+    writer.close()
+
+    for part in parts:
+        part.close()
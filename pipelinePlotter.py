@@ -37,6 +37,30 @@ import rpy2.robjects as robjects
 #  7  Different references: this read disagrees with it's ref
 ###############################################################################
 
+#
+# Load one contig out of a store made by sam2PairPlotCSV.py -z
+# This sets up the same R data frames plotPairs and plotCoverage read from the .csv files
+#
+def loadStoreContig(storeFileName, con_id, r):
+    from pairPlotStore import PairPlotStoreReader
+    store = PairPlotStoreReader(storeFileName)
+    if not store.hasContig(con_id):
+        print "Contig: " + con_id + " is not in store: " + storeFileName
+        sys.exit(1)
+    (position, insertsize, direction) = store.loadPairs(con_id)
+    robjects.globalenv['x'] = robjects.DataFrame({'position' : robjects.IntVector(position.tolist()),
+                                                  'insertsize' : robjects.IntVector(insertsize.tolist()),
+                                                  'direction' : robjects.IntVector(direction.tolist())})
+    (coverage, mode_coverage) = store.loadCoverage(con_id)
+    if coverage is None:
+        print "No coverage for contig: " + con_id + " in store: " + storeFileName + " -- was sam2PairPlotCSV.py run with -c?"
+        sys.exit(1)
+    first_position = store.coverageStart(con_id)
+    robjects.globalenv['cov_data'] = robjects.DataFrame({'position' : robjects.IntVector(range(first_position, first_position+len(coverage))),
+                                                         'coverage' : robjects.IntVector(coverage.tolist())})
+    robjects.globalenv['mode_cov_data'] = robjects.DataFrame({'mode_coverage' : robjects.IntVector([mode_coverage])})
+    store.close()
+
 #
 # Stuff
 #
@@ -57,8 +81,9 @@ def plotPairs(fileName, r):
 
     r("par(mar=c(1, 4, 0, 2) + 0.1);")
 
-    # readin and transform the file
-    r("x = read.csv(\""+fileName+"\")")
+    # readin and transform the file (it's already loaded if we are using a store)
+    if fileName is not None:
+        r("x = read.csv(\""+fileName+"\")")
     print "{{{" + str(r("maxsert = max(x$insertsize) * 1.5")) + "}}}"
     #r("scaling = (10^floor(log(max(x$position),10)-1))")
     #r("scaffoldsize = max(x$position)")
@@ -133,13 +158,15 @@ def plotCoverage(fileName, modeFileName, r):
 
     r("par(mar=c(1, 4, 0, 2) + 0.1);")
 
-    r("cov_data = read.csv(\""+fileName+"\")")
+    if fileName is not None:
+        r("cov_data = read.csv(\""+fileName+"\")")
     r("max_cov = max(cov_data$coverage) + 5")
     r("scaling = (10^floor(log(max(cov_data$position),10)-1))")
     r("scaffoldsize = max(cov_data$position)")
     r("roundedscaffoldsize = scaling*(floor(max(cov_data$position)/scaling)+1)")
 
-    r("mode_cov_data = read.csv(\""+modeFileName+"\");")
+    if modeFileName is not None:
+        r("mode_cov_data = read.csv(\""+modeFileName+"\");")
     r("mode_cov = max(mode_cov_data$mode_coverage);")
     r("mean_cov = mean(cov_data$coverage)")
 
@@ -272,24 +299,30 @@ def plotGC(fileName, r):
 if __name__ == '__main__':
 
     # intialise the options parser
-    parser = OptionParser("\n\n %prog -c csvFileName [-l image label]")
+    parser = OptionParser("\n\n %prog -c csvFileName [-l image label]\n %prog -s storeFileName -H heatmapFileName -l contig_id")
     parser.add_option("-p", "--pair_fileName", type="string", dest="pairCSVFileName", help="Specify a name for the pair plot CSV file")
     parser.add_option("-c", "--cov_fileName", type="string", dest="covCSVFileName", help="Specify a name for the coverage CSV file")
     parser.add_option("-m", "--mode_cov_fileName", type="string", dest="modeCovCSVFileName", help="Specify a name for the mode coverage CSV file")
     parser.add_option("-H", "--heatmap_fileName", type="string", dest="heatCSVFileName", help="Specify a name for the heat map CSV file")
     parser.add_option("-l", "--image_label", type="string", dest="imageLabel", help="Specify a label for the image")
+    parser.add_option("-s", "--store_fileName", type="string", dest="storeFileName", help="Load pairs and coverage for the contig named by -l from a sam2PairPlotCSV.py store instead of -p, -c and -m")
 
     # get and check options
     (opts, args) = parser.parse_args()
-    if (opts.pairCSVFileName is None):
+    if (opts.storeFileName is not None):
+        if (opts.imageLabel is None):
+            print ('You need to specify the contig to plot with -l when using a store')
+            parser.print_help()
+            sys.exit(1)
+    elif (opts.pairCSVFileName is None):
         print ('You need to specify a .csv file to parse for paired plotting')
         parser.print_help()
         sys.exit(1)
-    if (opts.covCSVFileName is None):
+    elif (opts.covCSVFileName is None):
         print ('You need to specify a .csv file to parse for coverage plotting')
         parser.print_help()
         sys.exit(1)
-    if (opts.modeCovCSVFileName is None):
+    elif (opts.modeCovCSVFileName is None):
         print ('You need to specify a .csv file to parse for mode coverage plotting')
         parser.print_help()
         sys.exit(1)
@@ -307,6 +340,9 @@ if __name__ == '__main__':
     # do stuff
     r = robjects.r
 
+    if (opts.storeFileName is not None):
+        loadStoreContig(opts.storeFileName, label, r)
+
     openRImageDevice(label, r)
     plotCoverage(opts.covCSVFileName, opts.modeCovCSVFileName, r)
     plotKmerHeatMap(opts.heatCSVFileName,  r)
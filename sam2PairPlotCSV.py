@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 import pysam
+import numpy as np
 import subprocess
 import os
 from optparse import OptionParser
 import random
 import sys
+import heapq
+import multiprocessing
+import json
+import hashlib
+import time
+import resource
+from array import array
+from collections import OrderedDict
+from pairPlotStore import PairPlotStoreWriter, mergePairPlotStores
 ###############################################################################
 #
 #    sam2PairPlotCSV.py
@@ -37,33 +47,121 @@ import sys
 #  7  Different references: this read disagrees with it's ref
 ###############################################################################
 #
-# Add a new entry to the Dict or append it onto the end of an existing entry
+# Compact storage for the pairs and single hits on one contig
 #
-def addPosRevToContigDictOrParse(dictionary, key, value, parsed_dictionary, rl):
+# Everything lives in parallel arrays (4 bytes a position, 1 byte a code) rather
+# than in a list of tuples per read. Which pair or single hit gets written out
+# at a position depends only on the mate positions and read names, never on the
+# order they were found in, so every parser writes the same rows.
+#
+class ContigPairRecords:
+    """Parallel array columns for the parsed pairs and single hits on a contig"""
+    def __init__(self):
+        self.positions = array('i')
+        self.inserts = array('i')
+        self.codes = array('b')
+        self.matePositions = array('i')
+        self.names = []
+        self.singlePositions = array('i')
+        self.singleCodes = array('b')
+        self.singleNames = []
+        self.coverStarts = array('i')
+        self.coverEnds = array('i')
+
+    def addPair(self, start, ins, code, matePos, name):
+        """A pair starting at start with the rightmost read at matePos"""
+        self.positions.append(start)
+        self.inserts.append(ins)
+        self.codes.append(code)
+        self.matePositions.append(matePos)
+        self.names.append(name)
+
+    def addSingle(self, pos, code, name):
+        self.singlePositions.append(pos)
+        self.singleCodes.append(code)
+        self.singleNames.append(name)
+
+    def addCover(self, start, end):
+        """A mapped read covering [start, end) (0 based)"""
+        self.coverStarts.append(start)
+        self.coverEnds.append(end)
+
+    def covers(self):
+        """Returns: (starts, ends) arrays for every mapped read"""
+        return (np.frombuffer(self.coverStarts, dtype=np.int32), np.frombuffer(self.coverEnds, dtype=np.int32))
+
+    def rows(self):
+        """Returns: (positions, inserts, codes) sorted by position with one row per position
+
+        The pair with the leftmost mate wins unless there is a single hit there
+        too, in which case a single hit wins with an insert of 1. Single hits
+        (4, 5) beat hits on different references (6, 7). Anything still tied
+        (duplicates) is settled on the read name, the smallest name for pairs
+        and the largest for single hits
+        """
+        positions = np.frombuffer(self.positions, dtype=np.int32)
+        inserts = np.frombuffer(self.inserts, dtype=np.int32)
+        codes = np.frombuffer(self.codes, dtype=np.int8)
+        order = np.lexsort((np.array(self.names, dtype=str), np.frombuffer(self.matePositions, dtype=np.int32), positions))
+        (positions, inserts, codes) = (positions[order], inserts[order], codes[order])
+        (pair_pos, first) = np.unique(positions, return_index=True)
+        pair_ins = inserts[first]
+        pair_codes = codes[first]
+
+        single_positions = np.frombuffer(self.singlePositions, dtype=np.int32)
+        single_codes = np.frombuffer(self.singleCodes, dtype=np.int8)
+        # 4 and 5 go after 6 and 7 so they are the last ones
+        order = np.lexsort((np.array(self.singleNames, dtype=str), single_codes < 6, single_positions))
+        (single_pos, last) = np.unique(single_positions[order][::-1], return_index=True)
+        single_codes = single_codes[order][::-1][last]
+
+        keep = np.logical_not(np.in1d(pair_pos, single_pos))
+        row_pos = np.concatenate((pair_pos[keep], single_pos))
+        order = np.argsort(row_pos, kind='mergesort')
+        return (row_pos[order],
+                np.concatenate((pair_ins[keep], np.ones(len(single_pos), dtype=np.int32)))[order],
+                np.concatenate((pair_codes[keep], single_codes))[order])
+
+#
+# Pack a (position, is_reverse, end) read into a single int and back again
+# Aligned lengths are capped at 2^31 which keeps this inside a machine int
+#
+def packRead(read):
+    (pos, is_reverse, end) = read
+    return (((pos << 31) | min(end - pos, 0x7fffffff)) << 1) | int(is_reverse)
+
+def unpackRead(packed):
+    pos = packed >> 32
+    return (pos, packed & 1, pos + ((packed >> 1) & 0x7fffffff))
+
+#
+# Add a new entry to the Dict or pair it up with the mate already there
+# dictionary looks like: { interned read name : packed (pos, reversed, end) }
+#
+def addPosRevToContigDictOrParse(dictionary, key, value, records):
     if key in dictionary:
         # check to make sure that the position for these two guys are the same
         # don't add it twice if this is trhe case
-        if(dictionary[key][0][0] != value[0]):
-            (start, ins, code) = getMappingCode(dictionary[key], value, rl)
+        mate = unpackRead(dictionary[key])
+        if(mate[0] != value[0]):
+            (start, ins, code) = getMappingCode(mate, value)
             # kill the old entry
             del dictionary[key]
             # add the parsed one...
-            if start in parsed_dictionary:
-                parsed_dictionary[start].append((ins, code))
-            else:
-                # { start_pos : (insert, code) }
-                parsed_dictionary[start] = [(ins, code)]
+            records.addPair(start, ins, code, max(mate[0], value[0]), key)
     else:
-        dictionary[key] = [value]
+        dictionary[intern(key)] = packRead(value)
 
 #
-# place an int in the dictionary or add to the one there...
+# Where the alignment ends on the reference (0 based, exclusive)
+# Uses the CIGAR so we never have to pull the sequence out of the record
 #
-def addOrAdd(dictionary, key, value):
-    if key in dictionary:
-        dictionary[key] = dictionary[key] + value
-    else:
-        dictionary[key] = value
+def readEnd(samRecord):
+    end = samRecord.aend
+    if end is None:
+        # no CIGAR to go on so assume it's all aligned
+        return samRecord.pos + samRecord.rlen
+    return end
 
 #
 # Strip the _ or - from the end of a query name
@@ -75,20 +173,41 @@ def sanitiseQName(qname):
     else:
         return qname
 
+#
+# Decide which read pairs make it into a subsample
+#
+# The decision comes from a hash of the (sanitised) read name so both reads of a
+# pair are always kept or dropped together and the same reads are picked every
+# run, whichever contig or process they end up in.
+#
+class ReadSampler:
+    """Deterministic hash-of-qname subsampling of read pairs"""
+    def __init__(self, fraction, seed=0):
+        self.fraction = fraction
+        self.seed = seed
+        self.threshold = int(fraction * 0x100000000)
+
+    def keep(self, qname):
+        # crc32 is linear so different seeds pick overlapping subsamples, md5 mixes the seed in properly
+        digest = hashlib.md5('%d\t%s' % (self.seed, sanitiseQName(qname))).hexdigest()
+        return int(digest[:8], 16) < self.threshold
+
 #
 # get a mapping code for the mapped pair
+# reads look like: (pos, is_reverse, end)
+# the insert runs from the start of the leftmost read to the end of whichever read finishes last
 #
-def getMappingCode(read_1, read_2, readLen):
+def getMappingCode(read_1, read_2):
     # these guys are not necessarilly sorted
     # do this first
-    if(read_1[0][0] < read_2[0]):
-        read1 = read_1[0]
+    if(read_1[0] < read_2[0]):
+        read1 = read_1
         read2 = read_2
     else:
-        read2 = read_1[0]
+        read2 = read_1
         read1 = read_2
 
-    ins_size = read2[0] + readLen - read1[0]
+    ins_size = max(read1[2], read2[2]) - read1[0]
     if read1[1] and read2[1]:
         return (read1[0], ins_size, 3)
     elif read1[1] == read2[1]:
@@ -99,11 +218,205 @@ def getMappingCode(read_1, read_2, readLen):
         return (read1[0], ins_size, 2)
 
 #
-# Parse through the sam file and work out orientations etc for each entry
-# Fill all the data structs needed for .csv file creation
+# Keep a limited number of files open at once
 #
-def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
-    # open the SAM/BAM
+# Writes are buffered per file and only hit the disk in big chunks. When we need
+# a handle and there are already maxOpen of them we close the least recently used
+# one; next time that file is written to it is opened in append mode.
+#
+class FileHandlePool:
+    """LRU pool of open file handles with per-file write buffers"""
+    def __init__(self, maxOpen=256, bufferSize=1048576, maxBuffered=67108864):
+        self.maxOpen = max(1, maxOpen)
+        self.bufferSize = bufferSize        # flush a single file when it has this much waiting
+        self.maxBuffered = maxBuffered      # flush everything when this much is waiting overall
+        self.handles = OrderedDict()        # { fileName : handle } least recently used first
+        self.buffers = {}                   # { fileName : [data, ...] }
+        self.bufferLens = {}                # { fileName : bytes waiting }
+        self.buffered = 0
+        self.started = set()                # files we have already created
+
+    def write(self, fileName, data):
+        if fileName in self.buffers:
+            self.buffers[fileName].append(data)
+            self.bufferLens[fileName] += len(data)
+        else:
+            self.buffers[fileName] = [data]
+            self.bufferLens[fileName] = len(data)
+        self.buffered += len(data)
+        if(self.bufferLens[fileName] >= self.bufferSize):
+            self.flush(fileName)
+        elif(self.buffered >= self.maxBuffered):
+            self.flushAll()
+
+    def flush(self, fileName):
+        if fileName in self.buffers:
+            self.getHandle(fileName).write("".join(self.buffers[fileName]))
+            self.buffered -= self.bufferLens[fileName]
+            del self.buffers[fileName]
+            del self.bufferLens[fileName]
+
+    def flushAll(self):
+        for fileName in sorted(self.buffers.keys()):
+            self.flush(fileName)
+
+    def getHandle(self, fileName):
+        if fileName in self.handles:
+            # most recently used goes to the back
+            handle = self.handles.pop(fileName)
+        else:
+            if(len(self.handles) >= self.maxOpen):
+                (old_name, old_handle) = self.handles.popitem(last=False)
+                old_handle.close()
+            if fileName in self.started:
+                handle = open(fileName, 'ab')
+            else:
+                handle = open(fileName, 'wb')
+                self.started.add(fileName)
+        self.handles[fileName] = handle
+        return handle
+
+    def close(self, fileName):
+        """Flush and close a file. Files we never wrote to are created empty"""
+        self.flush(fileName)
+        if fileName in self.handles:
+            self.handles.pop(fileName).close()
+        elif fileName not in self.started:
+            open(fileName, 'wb').close()
+            self.started.add(fileName)
+
+    def closeAll(self):
+        self.flushAll()
+        for handle in self.handles.itervalues():
+            handle.close()
+        self.handles = OrderedDict()
+
+#
+# Writes the per-contig .csv files for the pair and coverage plots
+#
+class ContigCSVWriter:
+    """Write pair and coverage .csv files for each contig through a FileHandlePool"""
+    def __init__(self, CSVFileName, maxOpenFiles=256):
+        self.CSVFileName = CSVFileName
+        self.pool = FileHandlePool(maxOpenFiles)
+
+    def fileName(self, con_id, suffix):
+        return con_id.replace(' ','_') + '_' + self.CSVFileName + suffix + '.csv'
+
+    def writePairs(self, con_id, positions, inserts, codes):
+        csv_name = self.fileName(con_id, '')
+        self.pool.write(csv_name, '"position","insertsize","direction"\n')
+        for chunk_start in range(0, len(positions), COVERAGE_CHUNK):
+            chunk_end = chunk_start + COVERAGE_CHUNK
+            rows = np.column_stack((positions[chunk_start:chunk_end], inserts[chunk_start:chunk_end], codes[chunk_start:chunk_end]))
+            self.pool.write(csv_name, ('%d,%d,%d\n' * len(rows)) % tuple(rows.ravel().tolist()))
+        self.pool.close(csv_name)
+
+    def writeCoverage(self, con_id, coverage, mode_coverage, firstPosition=1):
+        cov_name = self.fileName(con_id, '_coverage')
+        self.pool.write(cov_name, '"position","coverage"\n')
+        writeCoverageColumn(self.pool, cov_name, coverage, firstPosition)
+        self.pool.close(cov_name)
+
+        # write the mode
+        mode_name = self.fileName(con_id, '_mode_coverage')
+        self.pool.write(mode_name, '"mode_coverage"\n')
+        self.pool.write(mode_name, '{0}\n'.format(mode_coverage))
+        self.pool.close(mode_name)
+
+    def close(self):
+        self.pool.closeAll()
+
+#
+# Make somewhere to put the output
+#
+def makeContigWriter(CSVFileName, maxOpenFiles, storePath):
+    if storePath is None:
+        return ContigCSVWriter(CSVFileName, maxOpenFiles)
+    return PairPlotStoreWriter(storePath)
+
+#
+# Keep track of how fast things are going and where the time goes
+#
+# Progress goes to stderr every reportInterval seconds and everything can be
+# dumped to a JSON file at the end. Stages are 'pairing' (reading and pairing up
+# records), 'coverage' and 'writing'.
+#
+class ParseMetrics:
+    """Throughput counters, stage timers and per-contig timings for a parse"""
+    def __init__(self, reportInterval=10.0):
+        self.started = time.time()
+        self.lastReport = self.started
+        self.reportInterval = reportInterval
+        self.records = 0
+        self.bytesRead = 0
+        self.stages = { 'pairing' : 0.0, 'coverage' : 0.0, 'writing' : 0.0 }
+        self.contigs = OrderedDict()    # { label : { 'records' : x, 'seconds' : y } }
+
+    def addTime(self, stage, seconds):
+        self.stages[stage] += seconds
+
+    def addContig(self, label, records, seconds):
+        self.contigs[label] = { 'records' : records, 'seconds' : round(seconds, 6) }
+
+    def progress(self, records, samFile=None):
+        """Update the record count (and bytes read if we can tell) and report if it's been a while"""
+        self.records = records
+        if samFile is not None:
+            try:
+                # BAM offsets are BGZF virtual offsets, the compressed offset is in the top 48 bits
+                self.bytesRead = max(self.bytesRead, samFile.tell() >> 16)
+            except:
+                pass
+        if(time.time() - self.lastReport >= self.reportInterval):
+            self.report()
+
+    def merge(self, other):
+        """Fold in the toDict() of another ParseMetrics (eg. from a worker)"""
+        self.records += other['records']
+        # workers report absolute file offsets so the furthest one is the best we can do
+        self.bytesRead = max(self.bytesRead, other['bytes_read'])
+        for (stage, seconds) in other['stages'].iteritems():
+            self.stages[stage] += seconds
+        for (label, contig) in other['contigs'].iteritems():
+            self.contigs[label] = contig
+
+    def peakRSS(self):
+        """Peak resident set size in bytes for us and any workers we've waited on"""
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        if sys.platform == 'darwin':
+            return peak
+        return peak * 1024
+
+    def report(self):
+        self.lastReport = time.time()
+        elapsed = max(self.lastReport - self.started, 1e-9)
+        sys.stderr.write("%d records in %.1fs (%.0f records/s), %.1f MB read, peak RSS %.1f MB, pairing %.1fs, coverage %.1fs, writing %.1fs\n" %
+                         (self.records, elapsed, self.records / elapsed, self.bytesRead / 1048576.0, self.peakRSS() / 1048576.0,
+                          self.stages['pairing'], self.stages['coverage'], self.stages['writing']))
+
+    def toDict(self):
+        elapsed = time.time() - self.started
+        return { 'records' : self.records,
+                 'bytes_read' : self.bytesRead,
+                 'seconds' : round(elapsed, 6),
+                 'records_per_second' : round(self.records / max(elapsed, 1e-9), 2),
+                 'peak_rss_bytes' : self.peakRSS(),
+                 'stages' : dict(self.stages),
+                 'contigs' : self.contigs }
+
+    def writeJSON(self, fileName):
+        try:
+            with open(fileName, 'w') as fh:
+                fh.write(json.dumps(self.toDict(), indent=2))
+                fh.write("\n")
+        except IOError:
+            print "Unable to write metrics file: " + fileName
+
+#
+# Open the SAM/BAM or die trying
+#
+def openSamBam(samPath, useBinary):
     if (useBinary):
         try:
             samFile = pysam.Samfile(samPath, 'rb')
@@ -116,6 +429,74 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
         except:
             print "Unable to open SAM file -- did you supply a BAM file instead?"
             sys.exit(1)
+    return samFile
+
+#
+# Work out the per base coverage for positions 1 .. con_length
+# Every read covers [start, end). We drop +1 at the start and -1 at the end
+# into a difference array and cumsum it.
+#
+def calculateCoverage(con_length, starts, ends):
+    con_length = int(con_length)
+    diff = np.zeros(con_length + 2, dtype=np.int32)
+    # reads hanging off the front start at 1 and reads that are off either end never show up
+    starts = np.maximum(starts, 1)
+    on_contig = np.logical_and(starts <= con_length, ends > starts)
+    np.add.at(diff, starts[on_contig], 1)
+    np.add.at(diff, np.minimum(ends[on_contig], con_length + 1), -1)
+    return np.cumsum(diff[1:con_length+1], dtype=np.int32)
+
+#
+# Work out the mode of the coverage
+# Ties go to whichever height got to the top count first (ie. further left)
+# and if nothing occurs more than once the mode is 0
+#
+def calculateModeCoverage(coverage):
+    if (0 == len(coverage)):
+        return 0
+    counts = np.bincount(coverage)
+    max_occurance = counts.max()
+    if (max_occurance < 2):
+        return 0
+    heights = np.flatnonzero(counts == max_occurance)
+    if (1 == len(heights)):
+        return int(heights[0])
+    return int(min(heights, key=lambda h: np.flatnonzero(coverage == h)[max_occurance-1]))
+
+#
+# Write out position,coverage lines a big chunk at a time
+#
+COVERAGE_CHUNK = 1000000
+def writeCoverageColumn(pool, cov_name, coverage, firstPosition=1):
+    for chunk_start in range(0, len(coverage), COVERAGE_CHUNK):
+        chunk = coverage[chunk_start:chunk_start+COVERAGE_CHUNK]
+        positions = np.arange(chunk_start + firstPosition, chunk_start + len(chunk) + firstPosition)
+        pool.write(cov_name, ('%d,%d\n' * len(chunk)) % tuple(np.column_stack((positions, chunk)).ravel().tolist()))
+
+#
+# Write the coverage and mode coverage for [start, end) of a single contig
+#
+def writeContigCoverage(writer, con_id, start, end, records, metrics):
+    # every mapped read covers [read_start, read_end), shift to 1 based positions in the region
+    started = time.time()
+    (starts, ends) = records.covers()
+    coverage = calculateCoverage(end - start, starts.astype(np.int64) - start + 1, ends.astype(np.int64) - start + 1)
+    mode_coverage = calculateModeCoverage(coverage)
+    covered = time.time()
+    metrics.addTime('coverage', covered - started)
+    writer.writeCoverage(con_id, coverage, mode_coverage, start + 1)
+    metrics.addTime('writing', time.time() - covered)
+
+#
+# Parse through the sam file and work out orientations etc for each entry
+# Fill all the data structs needed for .csv file creation
+#
+def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName, maxOpenFiles=256, storePath=None, sampler=None, metrics=None):
+    if metrics is None:
+        metrics = ParseMetrics()
+
+    # open the SAM/BAM
+    samFile = openSamBam(samPath, useBinary)
 
     num_contigs =  len (samFile.header['SQ'])
     total_size = reduce(lambda x,y:x+y, samFile.lengths)
@@ -133,18 +514,13 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
     for i in range(0, num_contigs):
         contig_mappings[samFile.header['SQ'][i]['SN']] = {}
 
-    # store all the parsed mappings in this dictionary
+    # store all the parsed mappings in compact columns
     parsed_mappings = {}
     for i in range(0, num_contigs):
-        parsed_mappings[samFile.header['SQ'][i]['SN']] = {}
+        parsed_mappings[samFile.header['SQ'][i]['SN']] = ContigPairRecords()
 
-    # open the .csv files
-    csv_files = {}
-    for i in range(0, num_contigs):
-        csv_file = open(samFile.header['SQ'][i]['SN'].replace(' ','_') + '_' + CSVFileName + '.csv', 'wb')
-        csv_file.write('"position","insertsize","direction"\n')
-        # Do not close the filehandle now because they are still needed. This might cause a "Too many files open" error though...
-        csv_files[samFile.header['SQ'][i]['SN']] = [csv_file]
+    # the .csv files are only opened when there is something to write
+    writer = makeContigWriter(CSVFileName, maxOpenFiles, storePath)
 
     # start parsing
     samIter = samFile.fetch()
@@ -154,10 +530,10 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
         print "No reads found"
         return None
 
-    # now get the read length for all the reads
-    rl = len(samRecord.seq)
     parsed_lines = 0
-    total_parsed = 0
+    contig_records = [0] * num_contigs
+    contig_seconds = [0.0] * num_contigs
+    started = time.time()
 
     # first get all the "Good" mappings and add them to a dictionary
     # this is a crude type of sort...
@@ -165,18 +541,22 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
         stopAt = stopAt - 1
         parsed_lines = parsed_lines + 1
         name = sanitiseQName(samRecord.qname)
-        pair = (samRecord.pos, samRecord.is_reverse)
 
-        # if there was a mapping. Update the parsed mappings dictionary
-        # { start_pos : (insert, code), [(insert, code), ...] }
         if(0 <= samRecord.rname):
-            addPosRevToContigDictOrParse(contig_mappings[samFile.getrname(samRecord.rname)], name, pair, parsed_mappings[samFile.getrname(samRecord.rname)], rl)
+            contig_records[samRecord.rname] += 1
+
+        # if there was a mapping. Update the parsed mappings
+        # unmapped reads placed next to their mate are left out so the mate ends up a single hit
+        if(0 <= samRecord.rname and not samRecord.is_unmapped and (sampler is None or sampler.keep(samRecord.qname))):
+            con_id = samFile.getrname(samRecord.rname)
+            read = (samRecord.pos, samRecord.is_reverse, readEnd(samRecord))
+            if(makeCoverage):
+                parsed_mappings[con_id].addCover(read[0], read[2])
+            addPosRevToContigDictOrParse(contig_mappings[con_id], name, read, parsed_mappings[con_id])
 
         # keep the user in the loop
-        if(2000000 <= parsed_lines):
-            total_parsed = total_parsed + parsed_lines
-            print str(total_parsed) + " done..."
-            parsed_lines = 0
+        if(0 == parsed_lines & 0xffff):
+            metrics.progress(parsed_lines, samFile)
 
         # next record!
         try:
@@ -184,6 +564,8 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
         except:
             break
 
+    metrics.progress(parsed_lines, samFile)
+    metrics.addTime('pairing', time.time() - started)
     print "Parsed: " + str(parsed_lines)
 
     # if the user has specifed that we'd like to coverage then it's time to take a quick detour
@@ -191,61 +573,14 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
     if(makeCoverage):
         # for each contig in the file
         for i in range(0, num_contigs):
-            # reset these guys for the new contig
-            v_height = 0            # The height at any given position
-            incre_dict = {}         # Per position height increment
-            decre_dict = {}         # per position height decrement
-            max_occurance = 0;      # The number of times the most commonly occuring v_height occurs
-            mode_coverage = 0;      # The most commonly occuring v_height
-            mode_dict = {}          # for keeping track of mode
-
-            # make the .csv file and header
             con_id = samFile.header['SQ'][i]['SN']
             con_length = samFile.header['SQ'][i]['LN']
-            cov_file = open(con_id.replace(' ','_') + '_' + CSVFileName + '_coverage.csv', 'wb')
-            cov_file.write('"position","coverage"\n')
-
-            # for each position in the contig
-            for position in range(1, int(con_length)+1):
-                if position in parsed_mappings[con_id]:
-                    # there was at least one hit here! Go through all of them
-                    for hit_number in range(0, len(parsed_mappings[con_id][position])):
-                        insert = parsed_mappings[con_id][position][hit_number][0]
-                        # add in for the read
-                        addOrAdd(incre_dict, position, 1)
-                        addOrAdd(decre_dict, position + rl, 1)
-                        # add in for it's pair
-                        addOrAdd(incre_dict, position + insert, 1)
-                        addOrAdd(decre_dict, position + rl + insert, 1)
-                if position in incre_dict:
-                    # add to the coverage at this position
-                    v_height = v_height + incre_dict[position]
-                    del incre_dict[position]
-                if position in decre_dict:
-                    # add to the coverage at this position
-                    v_height = v_height - decre_dict[position]
-                    del decre_dict[position]
-
-                cov_file.write('{0},{1}\n'.format(position, v_height))
-
-                # update the "mode coverage"
-                if(v_height in mode_dict):
-                    mode_dict[v_height] = mode_dict[v_height] + 1
-                    if(mode_dict[v_height] > max_occurance):
-                        max_occurance = mode_dict[v_height]
-                        mode_coverage = v_height
-                else:
-                    mode_dict[v_height] = 1
-
-            cov_file.close()
-
-            # write the mode
-            cov_file = open(con_id.replace(' ','_') + '_' + CSVFileName + '_mode_coverage.csv', 'wb')
-            cov_file.write('"mode_coverage"\n')
-            cov_file.write('{0}\n'.format(mode_coverage))
-            cov_file.close()
+            started = time.time()
+            writeContigCoverage(writer, con_id, 0, con_length, parsed_mappings[con_id], metrics)
+            contig_seconds[i] += time.time() - started
 
     # now we save all the lost souls
+    started = time.time()
     # All the entries in the contig_mapping dictionary will be singly mapped
     # or mapped to two separate references
     holding_dictionary = {}
@@ -255,39 +590,51 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
             if key in holding_dictionary:
                 # this guy MUST be in a different scaffold
                 # and this is a mess...
-                if (holding_dictionary[key][1][0][1]):
+                (held_con_id, held_packed) = holding_dictionary[key]
+                (held_pos, held_rev, held_end) = unpackRead(held_packed)
+                if (held_rev):
                     code = 6
                 else:
                     code = 7
-                parsed_mappings[holding_dictionary[key][0]][holding_dictionary[key][1][0][0]] = [(1, code)]
+                parsed_mappings[held_con_id].addSingle(held_pos, code, key)
 
-                if (contig_mappings[con_id][key][0][1]):
+                (pos, rev, end) = unpackRead(contig_mappings[con_id][key])
+                if (rev):
                     code = 6
                 else:
                     code = 7
-                parsed_mappings[con_id][contig_mappings[con_id][key][0][0]] = [(1, code)]
+                parsed_mappings[con_id].addSingle(pos, code, key)
                 del holding_dictionary[key]
             else:
-                # { READ_ID : ( contigID , ( pos , reversed ) ) }
+                # { READ_ID : ( contigID , packed ( pos , reversed, end ) ) }
                 holding_dictionary[key] = (con_id, contig_mappings[con_id][key])
 
         del contig_mappings[con_id]
 
     # collect the last of the single mapped
     for key in holding_dictionary.iterkeys():
-        if (holding_dictionary[key][1][0][1]):
+        (held_con_id, held_packed) = holding_dictionary[key]
+        (held_pos, held_rev, held_end) = unpackRead(held_packed)
+        if (held_rev):
             code = 4
         else:
             code = 5
-        parsed_mappings[holding_dictionary[key][0]][holding_dictionary[key][1][0][0]] = [(1, code)]
+        parsed_mappings[held_con_id].addSingle(held_pos, code, key)
+    metrics.addTime('pairing', time.time() - started)
 
     # now we print .csv files and close them
+    started = time.time()
     for i in range(0, num_contigs):
         con_id = samFile.header['SQ'][i]['SN']
-        csv_file = csv_files[con_id][0]
-        for key in sorted(parsed_mappings[con_id].iterkeys()):
-            csv_file.write('{0},{1},{2}\n'.format(key, parsed_mappings[con_id][key][0][0], parsed_mappings[con_id][key][0][1]))
-        csv_file.close()
+        contig_started = time.time()
+        (positions, inserts, codes) = parsed_mappings[con_id].rows()
+        writer.writePairs(con_id, positions, inserts, codes)
+        contig_seconds[i] += time.time() - contig_started
+        # reading and pairing is one pass over everything so only coverage and writing are per contig
+        metrics.addContig(con_id, contig_records[i], contig_seconds[i])
+    writer.close()
+    metrics.addTime('writing', time.time() - started)
+    metrics.report()
 
     del holding_dictionary
     del parsed_mappings
@@ -296,18 +643,343 @@ def parseSamBam(samPath, useBinary, makeCoverage, stopAt, CSVFileName):
     # close sam
     samFile.close()
 
+#
+# Make sure there is an index to fetch contigs with and something in there
+#
+def checkStreamable(samFile):
+    try:
+        samFile.fetch().next()
+    except ValueError:
+        print "Streaming needs a sorted and indexed BAM file -- try running samtools index first"
+        sys.exit(1)
+    except StopIteration:
+        print "No reads found"
+        return False
+    return True
+
+#
+# Work out which bits of which contigs to parse
+# regionStrings look like samtools regions: 'contig', 'contig:start' or 'contig:start-end'
+# (1 based, inclusive). Without an end the region runs to the end of the contig
+# and a region given more than once is only parsed once
+# Returns: [(label, con_id, start, end), ...] with start, end 0 based and half open
+#
+def parseRegions(samFile, regionStrings):
+    con_lengths = dict(zip(samFile.references, samFile.lengths))
+    regions = []
+    seen = set()
+    for region_string in regionStrings:
+        region_string = region_string.strip()
+        if region_string in con_lengths:
+            # whole contig (this also copes with contig names that have a ':' in them)
+            region = (region_string, region_string, 0, con_lengths[region_string])
+            if region not in seen:
+                seen.add(region)
+                regions.append(region)
+            continue
+        (con_id, sep, span) = region_string.rpartition(':')
+        (start, dash, end) = span.partition('-')
+        try:
+            start = int(start.replace(',', ''))
+            if '' == end:
+                end = con_lengths.get(con_id, 0)
+            else:
+                end = int(end.replace(',', ''))
+        except ValueError:
+            start = None
+        if con_id not in con_lengths or start is None:
+            print "Can't make sense of region: " + region_string + " -- use contig, contig:start or contig:start-end"
+            sys.exit(1)
+        start = max(start, 1) - 1
+        end = min(end, con_lengths[con_id])
+        if(end <= start):
+            print "Region: " + region_string + " is empty"
+            sys.exit(1)
+        region = (con_id.replace(' ','_') + '_' + str(start + 1) + '-' + str(end), con_id, start, end)
+        if region not in seen:
+            seen.add(region)
+            regions.append(region)
+    return regions
+
+#
+# Regions to parse, one per line. Blank lines and lines starting with # are ignored
+#
+def readRegionFile(regionFileName):
+    region_strings = []
+    try:
+        with open(regionFileName, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+                if line != '' and line[0] != '#':
+                    region_strings.append(line)
+    except IOError:
+        print "Unable to open region file: " + regionFileName
+        sys.exit(1)
+    return region_strings
+
+#
+# All of every contig in the order they appear in the header
+#
+def wholeContigRegions(samFile):
+    return [(con_id, con_id, 0, con_length) for (con_id, con_length) in zip(samFile.references, samFile.lengths)]
+
+#
+# Parse the reads for [start, end) of one contig of a sorted, indexed BAM
+#
+# We don't need to hold read names until the mate turns up because each
+# record carries its mate's position and orientation. The leftmost read of a
+# pair is used to make the (insert, code) entry and the rightmost one is skipped.
+# The insert comes from TLEN, or the mate is assumed to be as long as this read if
+# the aligner didn't fill it in. Reads that start before the region still count
+# towards the coverage but their pairs belong to whoever is parsing that bit.
+# Returns: (ContigPairRecords, records_parsed)
+#
+def parseContigStream(samFile, con_id, start, end, makeCoverage, stopAt, sampler, metrics):
+    records = ContigPairRecords()
+    same_pos = {}           # pairs where both reads start at the same place
+    last_pos = -1
+    parsed_lines = 0
+    parsed_before = metrics.records     # from the regions done before this one
+    for samRecord in samFile.fetch(con_id, start, end):
+        if (0 == stopAt):
+            break
+        stopAt = stopAt - 1
+        parsed_lines = parsed_lines + 1
+        if(0 == parsed_lines & 0xffff):
+            metrics.progress(parsed_before + parsed_lines, samFile)
+        if samRecord.is_unmapped:
+            continue
+        if sampler is not None and not sampler.keep(samRecord.qname):
+            continue
+
+        pos = samRecord.pos
+        read_end = readEnd(samRecord)
+        if(makeCoverage):
+            records.addCover(pos, read_end)
+        if(pos < start):
+            continue
+        if(pos != last_pos):
+            same_pos = {}
+            last_pos = pos
+
+        name = sanitiseQName(samRecord.qname)
+        if (not samRecord.is_paired or samRecord.mate_is_unmapped):
+            # Single hit
+            if (samRecord.is_reverse):
+                records.addSingle(pos, 4, name)
+            else:
+                records.addSingle(pos, 5, name)
+        elif (samRecord.rnext != samRecord.rname):
+            # Different references
+            if (samRecord.is_reverse):
+                records.addSingle(pos, 6, name)
+            else:
+                records.addSingle(pos, 7, name)
+        elif (pos < samRecord.mpos):
+            # leftmost read of the pair, the mate is ahead of us
+            tlen = abs(samRecord.tlen)
+            if (0 < tlen):
+                mate_end = pos + tlen
+            else:
+                mate_end = samRecord.mpos + read_end - pos
+            (pair_start, ins, code) = getMappingCode((pos, samRecord.is_reverse, read_end), (samRecord.mpos, samRecord.mate_is_reverse, mate_end))
+            records.addPair(pair_start, ins, code, samRecord.mpos, name)
+        elif (pos == samRecord.mpos):
+            # these never get paired up in parseSamBam so they are treated as single hits
+            if name in same_pos:
+                del same_pos[name]
+            else:
+                same_pos[name] = True
+                if (samRecord.is_reverse):
+                    records.addSingle(pos, 4, name)
+                else:
+                    records.addSingle(pos, 5, name)
+        # else: rightmost read, we dealt with this pair when we saw its mate
+
+    return (records, parsed_lines)
+
+#
+# Parse, cover and write out a single region. Returns the number of records parsed
+#
+def processContigStream(samFile, writer, region, makeCoverage, stopAt, sampler, metrics):
+    (label, con_id, start, end) = region
+    started = time.time()
+    parsed_before = metrics.records
+    (records, parsed_lines) = parseContigStream(samFile, con_id, start, end, makeCoverage, stopAt, sampler, metrics)
+    metrics.addTime('pairing', time.time() - started)
+    if(makeCoverage):
+        writeContigCoverage(writer, label, start, end, records, metrics)
+    (positions, inserts, codes) = records.rows()
+    written = time.time()
+    writer.writePairs(label, positions, inserts, codes)
+    metrics.addTime('writing', time.time() - written)
+    metrics.addContig(label, parsed_lines, time.time() - started)
+    metrics.progress(parsed_before + parsed_lines, samFile)
+    return parsed_lines
+
+#
+# Streaming version of parseSamBam for coordinate sorted, indexed BAM files
+#
+# Contigs are fetched one at a time and their .csv files written as soon as
+# they are done so peak memory depends on the largest contig, not the whole file.
+# Give a list of regions to only fetch those bits of the file (see parseRegions)
+#
+def streamSamBam(samPath, makeCoverage, stopAt, CSVFileName, maxOpenFiles=256, storePath=None, regionStrings=None, sampler=None, metrics=None):
+    if metrics is None:
+        metrics = ParseMetrics()
+    samFile = openSamBam(samPath, True)
+
+    # take not of if the user set a stop point
+    if( 0 == stopAt):
+        stopAt = -1
+
+    if not checkStreamable(samFile):
+        return None
+
+    if regionStrings is None:
+        regions = wholeContigRegions(samFile)
+    else:
+        regions = parseRegions(samFile, regionStrings)
+
+    writer = makeContigWriter(CSVFileName, maxOpenFiles, storePath)
+    total_parsed = 0
+    for region in regions:
+        # contigs past the stop point still get (empty) .csv files
+        parsed_lines = processContigStream(samFile, writer, region, makeCoverage, stopAt, sampler, metrics)
+        total_parsed = total_parsed + parsed_lines
+        if (0 < stopAt):
+            stopAt = stopAt - parsed_lines
+    started = time.time()
+    writer.close()
+    metrics.addTime('writing', time.time() - started)
+    metrics.report()
+
+    print "Parsed: " + str(total_parsed)
+
+    # close sam
+    samFile.close()
+
+#
+# Split the contigs into num_units work units of roughly equal total length
+# Biggest contigs go first, each onto whichever unit is lightest at the time
+# Returns: [[index into lengths, ...], ...] with the heaviest units first
+#
+def partitionContigs(lengths, num_units):
+    num_units = max(1, min(num_units, len(lengths)))
+    units = [[] for i in range(num_units)]
+    loads = [(0, i) for i in range(num_units)]
+    for con_index in sorted(range(len(lengths)), key=lambda i: (-lengths[i], i)):
+        (load, unit) = heapq.heappop(loads)
+        units[unit].append(con_index)
+        heapq.heappush(loads, (load + lengths[con_index], unit))
+    loads.sort(key=lambda x: (-x[0], x[1]))
+    return [sorted(units[unit]) for (load, unit) in loads if len(units[unit]) > 0]
+
+#
+# Worker for streamSamBamParallel. Each worker opens its own handle on the BAM
+# and streams its regions through the same code the serial path uses
+# Returns: ([(region_index, records_parsed), ...], ParseMetrics.toDict())
+#
+def streamContigUnit(work):
+    (samPath, unit_regions, makeCoverage, CSVFileName, maxOpenFiles, storePath, sampler) = work
+    # workers keep quiet, the parent does the reporting
+    metrics = ParseMetrics(reportInterval=float('inf'))
+    samFile = openSamBam(samPath, True)
+    writer = makeContigWriter(CSVFileName, maxOpenFiles, storePath)
+    counts = []
+    for (i, region) in unit_regions:
+        counts.append((i, processContigStream(samFile, writer, region, makeCoverage, -1, sampler, metrics)))
+    started = time.time()
+    writer.close()
+    metrics.addTime('writing', time.time() - started)
+    samFile.close()
+    return (counts, metrics.toDict())
+
+#
+# Parallel version of streamSamBam. Contigs are split into work units balanced
+# by length and handed out to a pool of processes. Every contig gets its own
+# .csv files so the output is the same as the serial version. When writing a
+# store each unit gets its own part file and these are merged in contig order.
+#
+def streamSamBamParallel(samPath, makeCoverage, CSVFileName, numProcesses, maxOpenFiles=256, storePath=None, regionStrings=None, sampler=None, metrics=None):
+    if metrics is None:
+        metrics = ParseMetrics()
+    samFile = openSamBam(samPath, True)
+
+    if not checkStreamable(samFile):
+        return None
+
+    if regionStrings is None:
+        regions = wholeContigRegions(samFile)
+    else:
+        regions = parseRegions(samFile, regionStrings)
+    samFile.close()
+
+    # a few units per process so the stragglers don't hold everyone up
+    units = partitionContigs([end - start for (label, con_id, start, end) in regions], numProcesses * 4)
+    units = [[(i, regions[i]) for i in unit] for unit in units]
+    contig_order = [label for (label, con_id, start, end) in regions]
+
+    if storePath is None:
+        part_paths = [None for unit in units]
+    else:
+        part_paths = [storePath + '.part' + str(i) for i in range(0, len(units))]
+    work = [(samPath, units[i], makeCoverage, CSVFileName, maxOpenFiles, part_paths[i], sampler) for i in range(0, len(units))]
+    pool = multiprocessing.Pool(numProcesses)
+    try:
+        counts = []
+        for (unit_counts, unit_metrics) in pool.imap_unordered(streamContigUnit, work):
+            counts.extend(unit_counts)
+            metrics.merge(unit_metrics)
+            metrics.progress(metrics.records)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    # merge in contig order
+    counts.sort()
+    total_parsed = 0
+    for (i, parsed_lines) in counts:
+        total_parsed = total_parsed + parsed_lines
+
+    if storePath is not None:
+        started = time.time()
+        mergePairPlotStores(storePath, part_paths, contig_order)
+        for part_path in part_paths:
+            os.remove(part_path)
+        metrics.addTime('writing', time.time() - started)
+
+    # per contig timings in contig order too
+    metrics.contigs = OrderedDict((label, metrics.contigs[label]) for label in contig_order if label in metrics.contigs)
+    metrics.report()
+
+    print "Parsed: " + str(total_parsed)
+
 #
 # Entry sub. Parse vars and call parseSamBam
 #
 if __name__ == '__main__':
 
     # intialise the options parser
-    parser = OptionParser("%prog -s samFileName [-b] [-c] [-o CSV fileName] [-v]\n\t-- parse a sam/bam file and produce csv files")
+    parser = OptionParser("%prog -s samFileName [-b] [-c] [-S] [-P processes] [-r region | -R regionFile] [-o CSV fileName | -z store] [-v]\n\t-- parse a sam/bam file and produce csv files")
     parser.add_option("-s", "--sam", type="string", dest="samFileName", help="Give a SAM/BAM file name")
     parser.add_option("-b", "--binary", action="store_true", dest="useBinary", help="Set this if you use a BAM file [default: false]")
     parser.add_option("-c", "--coverage", action="store_true", dest="makeCoverage", help="Set this to output coverage information too [default: false]")
     parser.add_option("-o", "--csv_fileName", type="string", dest="CSVFileName", help="Specify a name for the CSV file [default: map_out.csv]")
     parser.add_option("-N", "--number_SAM", type="int", dest="samFileStop", help="Specify how many SAM / BAM records to parse")
+    parser.add_option("-S", "--stream", action="store_true", dest="stream", help="Parse a sorted, indexed BAM one contig at a time to keep memory down [default: false]")
+    parser.add_option("-P", "--processes", type="int", dest="processes", help="Stream contigs through this many processes (implies -S) [default: 1]")
+    parser.add_option("-F", "--max_open_files", type="int", dest="maxOpenFiles", default=256, help="The most .csv files to keep open at once (per process) [default: 256]")
+    parser.add_option("-z", "--store", type="string", dest="storeFileName", help="Write everything to this consolidated store instead of per-contig .csv files")
+    parser.add_option("-r", "--region", action="append", type="string", dest="regions", help="Only parse this contig, contig:start or contig:start-end region using the BAM index (implies -S, can be given more than once)")
+    parser.add_option("-R", "--region_file", type="string", dest="regionFileName", help="Only parse the contigs, contig:start or contig:start-end regions listed in this file, one per line (implies -S)")
+    parser.add_option("-f", "--sample_fraction", type="float", dest="sampleFraction", help="Only use this fraction of the read pairs, picked by hashing read names so mates stay together. Coverage is worked out from the sampled reads only [default: 1]")
+    parser.add_option("-M", "--metrics", type="string", dest="metricsFileName", help="Write throughput, memory and timing metrics to this JSON file when done")
+    parser.add_option("--report_interval", type="float", dest="reportInterval", default=10.0, help="Seconds between progress reports on stderr [default: 10]")
+    parser.add_option("--sample_seed", type="int", dest="sampleSeed", default=0, help="Change this to pick a different subsample [default: 0]")
 
     # get and check options
     (opts, args) = parser.parse_args()
@@ -334,5 +1006,46 @@ if __name__ == '__main__':
     else:
         stopPoint = opts.samFileStop
 
+    if(opts.processes is None):
+        processes = 1
+    else:
+        processes = opts.processes
+        if(processes < 1):
+            print("-P/--processes must be at least 1")
+            sys.exit(1)
+
+    sampler = None
+    if(opts.sampleFraction is not None):
+        if(opts.sampleFraction <= 0 or opts.sampleFraction > 1):
+            print("-f/--sample_fraction must be greater than 0 and no more than 1")
+            sys.exit(1)
+        if(opts.sampleFraction < 1):
+            sampler = ReadSampler(opts.sampleFraction, opts.sampleSeed)
+
+    metrics = ParseMetrics(opts.reportInterval)
+
+    region_strings = None
+    if(opts.regions is not None or opts.regionFileName is not None):
+        region_strings = []
+        if(opts.regionFileName is not None):
+            region_strings.extend(readRegionFile(opts.regionFileName))
+        if(opts.regions is not None):
+            region_strings.extend(opts.regions)
+
     # do stuff
-    parseSamBam(opts.samFileName, opts.useBinary, makeCoverage, stopPoint,  CSV_file_name)
+    if(opts.stream or processes > 1 or region_strings is not None):
+        if(opts.useBinary is None):
+            print("Streaming and regions only work with sorted, indexed BAM files (-b)")
+            sys.exit(1)
+        if(processes > 1):
+            if(stopPoint != 0):
+                print("-N/--number_SAM can't be used with more than one process")
+                sys.exit(1)
+            streamSamBamParallel(opts.samFileName, makeCoverage, CSV_file_name, processes, opts.maxOpenFiles, opts.storeFileName, region_strings, sampler, metrics)
+        else:
+            streamSamBam(opts.samFileName, makeCoverage, stopPoint, CSV_file_name, opts.maxOpenFiles, opts.storeFileName, region_strings, sampler, metrics)
+    else:
+        parseSamBam(opts.samFileName, opts.useBinary, makeCoverage, stopPoint,  CSV_file_name, opts.maxOpenFiles, opts.storeFileName, sampler, metrics)
+
+    if(opts.metricsFileName is not None):
+        metrics.writeJSON(opts.metricsFileName)
@@ -34,6 +34,25 @@ __status__ = "Development"
 import argparse
 import sys
 import os
+import re
+import gzip
+import zlib
+import threading
+from Queue import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from itertools import chain
+from cStringIO import StringIO
+from operator import itemgetter
+
+# how much to read from the input at a time when parsing in blocks
+BLOCK_SIZE = 1024 * 1024
+
+# the bit of a header line readfq calls the name
+FIRST_WORD = re.compile(r'^[@>](\S+)', re.M)
+
+# anything str.split() would split a header on, bar the newlines we split on anyway
+HEADER_SPACE = ' \t\r\x0b\x0c'
 
 ###############################################################################
 ###############################################################################
@@ -76,48 +95,464 @@ class ContigParser:
                     yield name, seq, None # yield a fasta record instead
                     break
 
+    def readfqBlocks(self, fp, blockSize=BLOCK_SIZE): # this is a generator function
+        """Yield lists of (name, seq, qual) tuples parsed from large blocks of fp
+
+        Four line fastq and (multi line) fasta are split up with str.split / str.find on
+        whole blocks instead of line by line. Anything else (wrapped fastq, truncated
+        records) is handed to readfq from that point on so we get the same answer.
+        """
+        buf = fp.read(blockSize)
+        if not buf or buf[0] not in '>@':
+            # leading junk or empty, let readfq sort it out
+            for batch in self._readfqFallback(buf, fp):
+                yield batch
+            return
+        if buf[0] == '>':
+            for batch in self._readfaBlocks(buf, fp, blockSize):
+                yield batch
+            return
+
+        get_first = itemgetter(slice(0, 1))
+        while True:
+            block = fp.read(blockSize)
+            lines = buf.split('\n')
+            if block or buf[-1] != '\n':
+                # the last line may be incomplete, keep it for next time (or readfq)
+                complete = ((len(lines) - 1) // 4) * 4
+            else:
+                # EOF, drop the empty 'line' after the final newline
+                lines.pop()
+                complete = (len(lines) // 4) * 4
+            headers = lines[0:complete:4]
+            pluses = lines[2:complete:4]
+            seqs = lines[1:complete:4]
+            quals = lines[3:complete:4]
+            if headers and (set(map(get_first, headers)) != set('@') or
+                            set(map(get_first, pluses)) != set('+') or
+                            map(len, seqs) != map(len, quals)):
+                # not four line fastq, let readfq deal with the rest
+                for batch in self._readfqFallback(buf + block, fp):
+                    yield batch
+                return
+            if headers:
+                yield zip(self._names(headers), seqs, quals)
+            if not block:
+                if complete != len(lines):
+                    # truncated record at the end of the file
+                    tail = '\n'.join(lines[complete:]) + ('\n' if buf[-1] == '\n' else '')
+                    for batch in self._readfqFallback(tail, fp):
+                        yield batch
+                return
+            buf = '\n'.join(lines[complete:]) + block
+
+    def _names(self, headers):
+        """First word of each header line minus the leading '@' or '>'"""
+        joined = '\n'.join(headers)
+        for c in HEADER_SPACE:
+            if c in joined:
+                break
+        else:
+            return joined[1:].split('\n' + joined[0])
+        names = FIRST_WORD.findall(joined)
+        if len(names) != len(headers):
+            # something like '@ name', do it the slow way
+            names = [h[1:].split(None, 1)[0] for h in headers]
+        return names
+
+    def _readfaBlocks(self, buf, fp, blockSize):
+        """Multi line fasta version of readfqBlocks, buf starts with a '>'
+
+        readfq starts a new record at any line starting with '@' or '+' and drops
+        the last character of a file that doesn't end in a newline, so we leave
+        those to readfq too.
+        """
+        while True:
+            block = fp.read(blockSize)
+            if block:
+                buf += block
+                cut = buf.rfind('\n>')
+                if cut == -1:
+                    continue
+                done = buf[1:cut]
+                rest = buf[cut+1:]
+            else:
+                done = buf[1:]
+                rest = ''
+            if '\n@' in done or '\n+' in done or (not block and buf[-1] != '\n'):
+                for batch in self._readfqFallback(buf, fp):
+                    yield batch
+                return
+            buf = rest
+            batch = []
+            for record in done.split('\n>'):
+                (header, _, seq) = record.partition('\n')
+                batch.append((header.split(None, 1)[0], seq.replace('\n', ''), None))
+            yield batch
+            if not block:
+                return
+
+    def _readfqFallback(self, buf, fp):
+        """Hand whatever is left over to readfq, in batches"""
+        if buf and buf[-1] != '\n':
+            # finish off the line we're half way through
+            buf += fp.readline()
+        batch = []
+        for record in self.readfq(chain(StringIO(buf), fp)):
+            batch.append(record)
+            if len(batch) >= 65536:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def readfqFast(self, fp, blockSize=BLOCK_SIZE): # this is a generator function
+        """Drop in replacement for readfq built on readfqBlocks"""
+        for batch in self.readfqBlocks(fp, blockSize):
+            for record in batch:
+                yield record
+
 
 ###############################################################################
 ###############################################################################
 ###############################################################################
 ###############################################################################
 
-def doWork( args ):
+class PipedReader:
+    """File like reader that reads (and gunzips) a file on a background thread"""
+    def __init__(self, fileName, gzipped, blockSize=BLOCK_SIZE, queueSize=8):
+        self.queue = Queue(queueSize)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.error = None
+        self.thread = threading.Thread(target=self._fill, args=(fileName, gzipped, blockSize))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self, fileName, gzipped, blockSize):
+        """Runs on the background thread, zlib lets go of the GIL while it works"""
+        try:
+            with open(fileName, 'rb') as fh:
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+                while True:
+                    raw = fh.read(blockSize)
+                    if not raw:
+                        break
+                    if d is None:
+                        self.queue.put(raw)
+                        continue
+                    data = d.decompress(raw)
+                    # gzip files can be several members back to back (pigz, bgzip, us)
+                    while d.unused_data:
+                        rest = d.unused_data
+                        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        data += d.decompress(rest)
+                    if data:
+                        self.queue.put(data)
+                if d is not None:
+                    data = d.flush()
+                    if data:
+                        self.queue.put(data)
+        except Exception as e:
+            self.error = e
+        self.queue.put(None)
+
+    def _more(self):
+        """Pull the next chunk off the queue, False at EOF"""
+        if self.eof:
+            return False
+        data = self.queue.get()
+        if data is None:
+            self.eof = True
+            if self.error is not None:
+                raise self.error
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buf) - self.pos < size) and self._more():
+            pass
+        if size < 0:
+            size = len(self.buf) - self.pos
+        data = self.buf[self.pos:self.pos+size]
+        self.pos += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            end = self.buf.find('\n', self.pos)
+            if end != -1:
+                data = self.buf[self.pos:end+1]
+                self.pos = end + 1
+                return data
+            if not self._more():
+                return self.read()
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        pass
+
+def compressChunk(data, level):
+    """Gzip data as a complete gzip member"""
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+class PipedGzipWriter:
+    """File like writer that gzips in chunks on a pool of threads
+
+    Each chunk is its own gzip member (like pigz -i or bgzip) which gzip, zcat
+    and gzip.open all read as one stream.
+    """
+    def __init__(self, fileName, threads, level=6, chunkSize=BLOCK_SIZE, pool=None):
+        self.fh = open(fileName, 'wb')
+        # writers can share a pool, whoever made it closes it
+        self.ownPool = pool is None
+        self.pool = ThreadPool(threads) if pool is None else pool
+        self.level = level
+        self.chunkSize = chunkSize
+        self.maxPending = threads * 2
+        self.pending = deque()
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.chunkSize:
+            self._submit()
+
+    def _submit(self):
+        self.pending.append(self.pool.apply_async(compressChunk, (''.join(self.parts), self.level)))
+        self.parts = []
+        self.size = 0
+        # write out finished chunks in order, don't let too many pile up
+        while len(self.pending) > self.maxPending:
+            self.fh.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.parts:
+            self._submit()
+        while self.pending:
+            self.fh.write(self.pending.popleft().get())
+        if self.ownPool:
+            self.pool.close()
+            self.pool.join()
+        self.fh.close()
+
+###############################################################################
+###############################################################################
+###############################################################################
+###############################################################################
+
+# one write per record pair is a lot of python calls and tiny gzip writes
+# so the interleaved records are joined up batchSize pairs at a time
+FASTQ_PAIR = "@%s\n%s\n+\n%s\n@%s\n%s\n+\n%s\n"
+BATCH_SIZE = 10000
+
+def formatRecord(cid, seq, qual):
+    if qual is None:
+        return "@%s\n%s\n" % (cid, seq)
+    return "@%s\n%s\n+\n%s\n" % (cid, seq, qual)
+
+class PairingError(Exception):
+    """The two reads of a pair don't line up"""
+    pass
+
+def mateName(cid):
+    """Read name without the /1 or /2 on the end (Casava 1.8+ mates already match)"""
+    if cid[-2:] in ('/1', '/2'):
+        return cid[:-2]
+    return cid
+
+def checkMates(f_cid, r_cid, pairs):
+    if f_cid != r_cid and mateName(f_cid) != mateName(r_cid):
+        raise PairingError("Mate names don't match at pair %d: %s and %s" % (pairs, f_cid, r_cid))
+
+def writeInterleaved(f_records, r_records, s, batchSize=BATCH_SIZE, check=False):
+    """Write pairs of records from the two iterators to s, one write per batchSize pairs
+
+    Raises PairingError if one runs out before the other or, with check, if mate names differ.
+    Returns the number of pairs written.
+    """
+    batch = []
+    written = 0
+    for f_cid,f_seq,f_qual in f_records:
+        try:
+            r_cid,r_seq,r_qual = r_records.next()
+        except StopIteration:
+            s.write(''.join(batch))
+            raise PairingError("R2 ran out of reads after %d pairs, %s has no mate" % (written + len(batch), f_cid))
+        if check:
+            checkMates(f_cid, r_cid, written + len(batch) + 1)
+        if f_qual is not None and r_qual is not None:
+            batch.append(FASTQ_PAIR % (f_cid, f_seq, f_qual, r_cid, r_seq, r_qual))
+        else:
+            batch.append(formatRecord(f_cid, f_seq, f_qual) + formatRecord(r_cid, r_seq, r_qual))
+        if len(batch) >= batchSize:
+            s.write(''.join(batch))
+            written += len(batch)
+            batch = []
+    s.write(''.join(batch))
+    written += len(batch)
+    for (r_cid, r_seq, r_qual) in r_records:
+        raise PairingError("R1 ran out of reads after %d pairs, %s has no mate" % (written, r_cid))
+    return written
+
+def writeSharded(f_records, r_records, shards, batchSize=BATCH_SIZE, check=False, chunkPairs=1):
+    """writeInterleaved into several outputs, chunkPairs pairs to each in turn
+
+    chunkPairs = 1 deals the pairs out round robin. The batchSize is shared between
+    the shards so memory use doesn't grow with the number of shards.
+    Returns the number of pairs written.
+    """
+    batches = [[] for i in shards]
+    shard_batch_size = max(1, batchSize // len(shards))
+    shard = 0
+    left = chunkPairs
+    batch = batches[0]
+    pairs = 0
+    for f_cid,f_seq,f_qual in f_records:
+        try:
+            r_cid,r_seq,r_qual = r_records.next()
+        except StopIteration:
+            for (s, batch) in zip(shards, batches):
+                s.write(''.join(batch))
+            raise PairingError("R2 ran out of reads after %d pairs, %s has no mate" % (pairs, f_cid))
+        pairs += 1
+        if check:
+            checkMates(f_cid, r_cid, pairs)
+        if f_qual is not None and r_qual is not None:
+            batch.append(FASTQ_PAIR % (f_cid, f_seq, f_qual, r_cid, r_seq, r_qual))
+        else:
+            batch.append(formatRecord(f_cid, f_seq, f_qual) + formatRecord(r_cid, r_seq, r_qual))
+        left -= 1
+        if left == 0:
+            if len(batch) >= shard_batch_size:
+                shards[shard].write(''.join(batch))
+                batches[shard] = []
+            shard = (shard + 1) % len(shards)
+            batch = batches[shard]
+            left = chunkPairs
+        elif len(batch) >= shard_batch_size:
+            shards[shard].write(''.join(batch))
+            batch = batches[shard] = []
+    for (s, batch) in zip(shards, batches):
+        s.write(''.join(batch))
+    for (r_cid, r_seq, r_qual) in r_records:
+        raise PairingError("R1 ran out of reads after %d pairs, %s has no mate" % (pairs, r_cid))
+    return pairs
+
+def shardName(fileName, shard, numShards):
+    """reads.fq.gz -> reads.07.fq.gz"""
+    (base, gz) = (fileName[:-3], fileName[-3:]) if fileName.endswith('.gz') else (fileName, '')
+    (base, ext) = os.path.splitext(base)
+    return "%s.%0*d%s%s" % (base, len(str(numShards - 1)), shard, ext, gz)
+
+def writeDeinterleaved(records, f, r, batchSize=BATCH_SIZE, check=False):
+    """Split alternating R1/R2 records from one iterator into f and r, the inverse of writeInterleaved
+
+    Returns the number of pairs written.
+    """
+    records = iter(records)
+    f_batch = []
+    r_batch = []
+    written = 0
+    for f_cid,f_seq,f_qual in records:
+        try:
+            r_cid,r_seq,r_qual = records.next()
+        except StopIteration:
+            f.write(''.join(f_batch))
+            r.write(''.join(r_batch))
+            raise PairingError("Odd number of reads, %s has no mate" % f_cid)
+        if check:
+            checkMates(f_cid, r_cid, written + len(f_batch) + 1)
+        f_batch.append(formatRecord(f_cid, f_seq, f_qual))
+        r_batch.append(formatRecord(r_cid, r_seq, r_qual))
+        if len(f_batch) >= batchSize:
+            f.write(''.join(f_batch))
+            r.write(''.join(r_batch))
+            written += len(f_batch)
+            f_batch = []
+            r_batch = []
+    f.write(''.join(f_batch))
+    r.write(''.join(r_batch))
+    return written + len(f_batch)
+
+def openInput(fileName, threads):
+    """Open a (possibly gzipped) fastq, on a background thread if we have threads"""
     import mimetypes
+    gzipped = (mimetypes.guess_type(fileName)[1] == 'gzip')
+    if threads > 0:
+        # decompress each input on its own thread
+        return PipedReader(fileName, gzipped)
+    if gzipped:
+        return gzip.open(fileName, "r")
+    return open(fileName, "r")
+
+def openOutput(fileName, threads, level, pool=None):
+    """Open an output, gzipped if the name ends in gz, on a pool of threads if we have threads"""
+    if fileName[len(fileName)-2:] == "gz":
+        if threads > 0:
+            return PipedGzipWriter(fileName, threads, level, pool=pool)
+        return gzip.open(fileName, "w")
+    return open(fileName, "w")
+
+def doWork( args ):
+    inputs = []
+    outputs = []
+    pool = None
     try:
-        GM_open = open
         try:
-            # handle gzipped files
-            mime = mimetypes.guess_type(args.forward)
-            if mime[1] == 'gzip':
-                import gzip
-                GM_open = gzip.open
-        except:
-            print "Error when guessing contig file mimetype"
-            raise
-        f = GM_open(args.forward, "r")
-        r = GM_open(args.reverse, "r")
-        if args.shuffled[len(args.shuffled)-2:] == "gz":
-            s = gzip.open(args.shuffled, "w")
-        else:
-            s = open(args.shuffled, "w")
-        f_CP = ContigParser()
-        r_CP = ContigParser()
-        Rs = r_CP.readfq(r)
-        for f_cid,f_seq,f_qual in f_CP.readfq(f):
-            
-            r_cid,r_seq,r_qual = Rs.next()
-            s.write("@%s\n" % f_cid)
-            s.write("%s\n" % f_seq)
-            if f_qual is not None:
-                s.write("+\n%s\n" % f_qual)
-            s.write("@%s\n" % r_cid)
-            s.write("%s\n" % r_seq)
-            if r_qual is not None:
-                s.write("+\n%s\n" % r_qual)
-        f.close()
-        r.close()
-        s.close()
+            if args.deinterleave:
+                s = openInput(args.shuffled, args.threads)
+                inputs.append(s)
+                f = openOutput(args.forward, args.threads, args.level)
+                outputs.append(f)
+                r = openOutput(args.reverse, args.threads, args.level)
+                outputs.append(r)
+                writeDeinterleaved(ContigParser().readfqFast(s), f, r, args.batch_size, args.check)
+            else:
+                f = openInput(args.forward, args.threads)
+                inputs.append(f)
+                r = openInput(args.reverse, args.threads)
+                inputs.append(r)
+                f_CP = ContigParser()
+                r_CP = ContigParser()
+                if args.shards > 1:
+                    # one pool of compression threads for all the shards
+                    pool = ThreadPool(args.threads) if args.threads > 0 else None
+                    shards = []
+                    for i in range(args.shards):
+                        shards.append(openOutput(shardName(args.shuffled, i, args.shards), args.threads, args.level, pool))
+                        outputs.append(shards[-1])
+                    writeSharded(f_CP.readfqFast(f), r_CP.readfqFast(r), shards, args.batch_size, args.check, args.chunk_pairs)
+                else:
+                    s = openOutput(args.shuffled, args.threads, args.level)
+                    outputs.append(s)
+                    writeInterleaved(f_CP.readfqFast(f), r_CP.readfqFast(r), s, args.batch_size, args.check)
+        finally:
+            # even when the reads don't pair up, so the outputs are complete
+            # (gzip) files holding every pair written before the error
+            for fh in outputs:
+                fh.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+            for fh in inputs:
+                fh.close()
+
+    except PairingError as e:
+        print "Reads are not properly paired:", e
+        return 1
 
     except:
         print "Could not parse contig file:",args.forward,sys.exc_info()[0]
@@ -133,15 +568,26 @@ def doWork( args ):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('forward', help="R1")
-    parser.add_argument('reverse', help="R2")
-    parser.add_argument('shuffled', help="name of shuffled file")
+    parser.add_argument('forward', help="R1 (output with -d)")
+    parser.add_argument('reverse', help="R2 (output with -d)")
+    parser.add_argument('shuffled', help="name of shuffled file (input with -d)")
+    parser.add_argument('-d', '--deinterleave', action="store_true", default=False, help="split shuffled back into forward and reverse")
+    parser.add_argument('-c', '--check', action="store_true", default=False, help="make sure mate names match (ignoring /1 and /2)")
+    parser.add_argument('-n', '--shards', type=int, default=1, help="split the shuffled output into this many files, shuffled.00.fq.gz etc. [default: 1]")
+    parser.add_argument('-k', '--chunk_pairs', type=int, default=1, help="with --shards, send this many consecutive pairs to each shard in turn (1 = round robin) [default: 1]")
+    parser.add_argument('-t', '--threads', type=int, default=0, help="read and gunzip the inputs on their own threads and gzip the output on this many threads (0 = all on one thread) [default: 0]")
+    parser.add_argument('-B', '--batch_size', type=int, default=BATCH_SIZE, help="number of pairs to join up before each write [default: %d]" % BATCH_SIZE)
+    parser.add_argument('-l', '--level', type=int, default=6, help="gzip compression level used with --threads [default: 6]")
 
     # parse the arguments
     args = parser.parse_args()
+    if args.deinterleave and args.shards > 1:
+        parser.error("--shards only works when shuffling")
+    if args.shards < 1 or args.chunk_pairs < 1:
+        parser.error("--shards and --chunk_pairs must be at least 1")
 
     # do what we came here to do
-    doWork(args)
+    sys.exit(doWork(args))
 
 ###############################################################################
 ###############################################################################
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+#=======================================================================
+# Author:
+#
+# Throughput benchmarks for shuffle.py.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+# Run from the test directory:
+#
+#   python bench_shuffle.py [-m MB]
+#
+# The reads.*.fq.gz fixtures are only a couple of records each so they get
+# repeated until the scaled up files are about MB megabytes (uncompressed).
+
+import argparse
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+data_dir = 'data/'
+sys.path.insert(0, '..')
+from shuffle import ContigParser, writeInterleaved
+
+
+def scaleUp(fixture, outFileName, megabytes):
+    fh = gzip.open(fixture)
+    records = fh.read()
+    fh.close()
+    copies = max(1, (megabytes * 1024 * 1024) // len(records))
+    with open(outFileName, 'w') as out:
+        for i in xrange(copies):
+            out.write(records)
+    return os.path.getsize(outFileName)
+
+
+def timeParser(name, parse, fileName, size):
+    started = time.time()
+    records = 0
+    fh = open(fileName)
+    records = parse(fh)
+    fh.close()
+    elapsed = time.time() - started
+    print "%-12s %10d records %8.2fs %8.3f GB/s" % (name, records, elapsed, size / elapsed / 1e9)
+    return elapsed
+
+
+def countReadfq(fh):
+    records = 0
+    for record in ContigParser().readfq(fh):
+        records += 1
+    return records
+
+
+def countReadfqFast(fh):
+    records = 0
+    for record in ContigParser().readfqFast(fh):
+        records += 1
+    return records
+
+
+def countReadfqBlocks(fh):
+    records = 0
+    for batch in ContigParser().readfqBlocks(fh):
+        records += len(batch)
+    return records
+
+
+def writeOneAtATime(f_records, r_records, s, batchSize):
+    # what shuffle.doWork used to do
+    for f_cid,f_seq,f_qual in f_records:
+        r_cid,r_seq,r_qual = r_records.next()
+        s.write("@%s\n" % f_cid)
+        s.write("%s\n" % f_seq)
+        if f_qual is not None:
+            s.write("+\n%s\n" % f_qual)
+        s.write("@%s\n" % r_cid)
+        s.write("%s\n" % r_seq)
+        if r_qual is not None:
+            s.write("+\n%s\n" % r_qual)
+
+
+def timeWriter(name, write, forward, reverse, shuffled, batchSize):
+    # parse up front so only the writing gets timed
+    f_records = list(ContigParser().readfqFast(open(forward)))
+    r_records = list(ContigParser().readfqFast(open(reverse)))
+    if shuffled.endswith('gz'):
+        s = gzip.open(shuffled, 'w')
+    else:
+        s = open(shuffled, 'w')
+    started = time.time()
+    write(iter(f_records), iter(r_records), s, batchSize)
+    s.close()
+    elapsed = time.time() - started
+    print "%-24s %8.2fs %8.1f MB/s" % (name, elapsed, os.path.getsize(forward) * 2 / elapsed / 1e6)
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--megabytes', type=int, default=256, help="size of the scaled up fastq files [default: 256]")
+    parser.add_argument('-w', '--write_megabytes', type=int, default=64, help="size of the scaled up fastq files for the write benchmarks [default: 64]")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fq_1 = os.path.join(tmp_dir, 'reads.1.fq')
+        size = scaleUp(data_dir+'reads.1.fq.gz', fq_1, args.megabytes)
+        print "parsing %.1f MB of fastq" % (size / 1048576.0)
+        base = timeParser('readfq', countReadfq, fq_1, size)
+        fast = timeParser('readfqFast', countReadfqFast, fq_1, size)
+        blocks = timeParser('readfqBlocks', countReadfqBlocks, fq_1, size)
+        print "speedup: %.1fx (records) %.1fx (batches)" % (base / fast, base / blocks)
+
+        fq_1 = os.path.join(tmp_dir, 'reads.1.fq')
+        fq_2 = os.path.join(tmp_dir, 'reads.2.fq')
+        scaleUp(data_dir+'reads.1.fq.gz', fq_1, args.write_megabytes)
+        scaleUp(data_dir+'reads.2.fq.gz', fq_2, args.write_megabytes)
+        for suffix in ['fq', 'fq.gz']:
+            shuffled = os.path.join(tmp_dir, 'shuffled.'+suffix)
+            print "writing %s (MB/s of input)" % suffix
+            base = timeWriter('one write at a time', writeOneAtATime, fq_1, fq_2, shuffled, 1)
+            for batch_size in [100, 1000, 10000]:
+                batched = timeWriter('batch size %d' % batch_size, writeInterleaved, fq_1, fq_2, shuffled, batch_size)
+            print "speedup: %.1fx" % (base / batched)
+    finally:
+        shutil.rmtree(tmp_dir)
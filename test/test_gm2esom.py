@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+#=======================================================================
+# Author:
+#
+# Unit tests for gm2esom.py.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import sys
+import subprocess
+import tempfile
+import shutil
+import random
+import os.path
+import json
+from cStringIO import StringIO
+
+path_to_script = '../gm2esom.py'
+sys.path.insert(0, '..')
+import gm2esom
+
+
+class UpdateTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.rand = random.Random(0)
+    # contigs are chopped into several rows and not always next to each other
+    rows = []
+    for i in range(60):
+      cid = 'scaffold_%d' % i
+      for j in range(self.rand.randint(1, 4)):
+        rows.append(cid + '_' + str(j))
+      if i % 7 == 0:
+        rows.append(cid + '_leftover_1')
+    self.rand.shuffle(rows)
+    self.cids = ['scaffold_%d' % i for i in range(60)]
+    self.names = self.path('esom.names')
+    with open(self.names, 'w') as fh:
+      fh.write(''.join('%d\t%s\t%s\n' % (i + 1, cid, 'x' * 3) for (i, cid) in enumerate(rows)))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def path(self, name):
+    return os.path.join(self.tmp_dir, name)
+
+  def writeBins(self, name, numBins, binned):
+    with open(self.path(name), 'w') as fh:
+      for cid in self.rand.sample(self.cids, binned):
+        fh.write('%d\t%s\n' % (self.rand.randint(1, numBins), cid))
+    return self.path(name)
+
+  def runScript(self, *args):
+    subprocess.check_call(' '.join((path_to_script,) + args), shell=True, stderr=open(os.devnull, 'w'))
+
+  def read(self, name):
+    with open(self.path(name)) as fh:
+      return fh.read()
+
+  def testUpdateMatchesRegeneration(self):
+    for (old_bins, new_bins) in [(5, 5), (5, 8), (8, 3)]:
+      old_gmbin = self.writeBins('old.txt', old_bins, 40)
+      new_gmbin = self.writeBins('new.txt', new_bins, 45)
+      self.runScript(old_gmbin, self.names, '-o', self.path('old.cls'))
+      self.runScript(new_gmbin, self.names, '-o', self.path('full.cls'))
+      self.runScript(new_gmbin, self.names, '-o', self.path('updated.cls'), '-u', self.path('old.cls'), '-g', old_gmbin)
+      self.assertEqual(self.read('full.cls'), self.read('updated.cls'))
+
+  def testUpdateInPlace(self):
+    old_gmbin = self.writeBins('old.txt', 6, 40)
+    new_gmbin = self.writeBins('new.txt', 6, 40)
+    self.runScript(old_gmbin, self.names, '-o', self.path('bins.cls'))
+    self.runScript(new_gmbin, self.names, '-o', self.path('full.cls'))
+    self.runScript(new_gmbin, self.names, '-o', self.path('bins.cls'), '-u', self.path('bins.cls'), '-g', old_gmbin)
+    self.assertEqual(self.read('full.cls'), self.read('bins.cls'))
+
+  def testSmallBlocks(self):
+    # changed rows right at, either side of and spanning block boundaries
+    old_gmbin = self.writeBins('old.txt', 4, 50)
+    new_gmbin = self.writeBins('new.txt', 4, 50)
+    self.runScript(old_gmbin, self.names, '-o', self.path('old.cls'))
+    self.runScript(new_gmbin, self.names, '-o', self.path('full.cls'))
+    (runs, num_rows) = gm2esom.buildRowIndex(self.names)
+    (old_bins, old_bin_ids) = gm2esom.readGmBins(old_gmbin)
+    (new_bins, new_bin_ids) = gm2esom.readGmBins(new_gmbin)
+    changes = gm2esom.changedRows(old_bins, new_bins, runs)
+    self.assertTrue(len(changes) > 0)
+    bin_cols = gm2esom.paletteColours(new_bin_ids)
+    for block_size in [1, 2, 3, 5, 8, 13, 64, 1024]:
+      out = StringIO()
+      gm2esom.updateClassFile(self.path('old.cls'), out, num_rows, new_bin_ids, bin_cols, changes, block_size)
+      self.assertEqual(self.read('full.cls'), out.getvalue(), "block size %d" % block_size)
+
+  def testRowIndexMatchesNames(self):
+    (runs, num_rows) = gm2esom.buildRowIndex(self.names)
+    rows = {}
+    for (base_name, base_runs) in runs.iteritems():
+      for (first_row, length) in base_runs:
+        for row in range(first_row, first_row + length):
+          rows[row] = base_name
+    with open(self.names) as fh:
+      expected = [gm2esom.esomBaseName(line.split('\t')[1]) for line in fh]
+    self.assertEqual(len(expected), num_rows)
+    self.assertEqual(expected, [rows[row] for row in range(1, num_rows + 1)])
+
+  def testSeveralGmbinsMatchOneAtATime(self):
+    gmbins = [self.writeBins('bins%d.txt' % i, 3 + i, 30) for i in range(3)]
+    self.runScript(' '.join(gmbins), self.names, '-d', self.tmp_dir)
+    for i in range(3):
+      self.runScript(gmbins[i], self.names, '-o', self.path('single.cls'))
+      self.assertEqual(self.read('single.cls'), self.read('bins%d.cls' % i))
+
+
+
+class ColourTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.names = os.path.join(self.tmp_dir, 'esom.names')
+    with open(self.names, 'w') as fh:
+      fh.write(''.join('%d\tscaffold_%d_0\tx\n' % (i + 1, i) for i in range(10)))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def classFile(self, bins, *args):
+    gmbin = os.path.join(self.tmp_dir, 'bins.txt')
+    with open(gmbin, 'w') as fh:
+      for (i, bid) in enumerate(bins):
+        fh.write('%d\tscaffold_%d\n' % (bid, i))
+    out = os.path.join(self.tmp_dir, 'bins.cls')
+    ret = subprocess.call(' '.join((path_to_script, gmbin, self.names, '-o', out) + args), shell=True, stdout=open(os.devnull, 'w'))
+    if ret != 0:
+      return None
+    with open(out) as fh:
+      lines = fh.read().split('\n')
+    # { class id : colour line }
+    return dict(line.split('\t', 1) for line in lines[2:] if '%' in line)
+
+  def testClassesAreBinIds(self):
+    classes = self.classFile([1, 2, 7, 7])
+    self.assertEqual(sorted(classes.keys()), ['1%', '2%', '7%'])
+    self.assertTrue(classes['7%'].startswith('7\t'))
+
+  def testColoursStickToBinIds(self):
+    cache = os.path.join(self.tmp_dir, 'colours.json')
+    first = self.classFile([1, 2, 7], '-c', cache)
+    second = self.classFile([1, 7, 9], '-c', cache)
+    self.assertEqual(first['1%'], second['1%'])
+    self.assertEqual(first['7%'], second['7%'])
+    self.assertEqual(sorted(json.load(open(cache))['colours'].keys()), ['1', '2', '7', '9'])
+    # the cache is made with the golden palette
+    self.assertEqual(None, self.classFile([1, 7, 9], '-c', cache, '-p', 'even'))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -26,6 +26,8 @@ import sys
 import subprocess
 import tempfile
 import os.path
+import fcntl
+import time
 
 data_dir = 'data/'
 path_to_script = '../makeSam.py'
@@ -82,8 +84,14 @@ class VerifyPostHocTests(unittest.TestCase):
     bamOutputFile = '/tmp/a'+'.bam'
     # Create dummy index files
     subprocess.check_call(path_to_script+' -1 data/reads.fq.gz -d data/ref.fna --keep --bwa-aln >/dev/null', shell=True)
-    ret = subprocess.call(path_to_script+' -1 data/reads.fq.gz -d data/ref.fna --bwa-aln >/dev/null', shell=True)
+    # building them next to the database again would overwrite them
+    ret = subprocess.call(path_to_script+' -1 data/reads.fq.gz -d data/ref.fna --bwa-aln --no_index_cache >/dev/null', shell=True)
     self.assertEqual(ret, 1)
+    # but the index cache leaves them alone
+    cache_dir = tempfile.mkdtemp()
+    ret = subprocess.call(path_to_script+' -1 data/reads.fq.gz -d data/ref.fna --bwa-aln -C '+cache_dir+' >/dev/null', shell=True)
+    self.assertEqual(ret, 0)
+    os.system('rm -r ' +cache_dir)
     ret = subprocess.call(path_to_script+' -1 data/reads.fq.gz -d data/ref.fna --bwa-aln --kept >/dev/null', shell=True)
     self.assertEqual(ret, 0)
 
@@ -95,6 +103,38 @@ class VerifyPostHocTests(unittest.TestCase):
     os.system('rm ' +d+'.pac')
     os.system('rm ' +d+'.sa')
 
+  def testIndexCacheReused(self):
+    cache_dir = tempfile.mkdtemp()
+    for i in range(2):
+      subprocess.check_call(path_to_script+' -1 data/reads.fq.gz -d data/ref.fna --bwa-aln -C '+cache_dir+' >/dev/null', shell=True)
+    # one index, built in the cache rather than next to the database
+    entries = [e for e in os.listdir(cache_dir) if os.path.isdir(os.path.join(cache_dir, e))]
+    self.assertEqual(len(entries), 1)
+    self.assertTrue(os.path.isfile(os.path.join(cache_dir, entries[0], 'ref.bwt')))
+    self.assertFalse(os.path.isfile('data/ref.fna.bwt'))
+    os.system('rm -r ' +cache_dir)
+
+  def testIndexCacheRunsDontBlock(self):
+    cache_dir = tempfile.mkdtemp()
+    command = path_to_script+' -1 data/reads.fq.gz -d data/ref.fna --bwa-aln -C '+cache_dir+' >/dev/null 2>&1'
+    # two at once on an empty cache, one builds the index and both use it
+    runs = [subprocess.Popen(command, shell=True) for i in range(2)]
+    self.assertEqual([0, 0], [run.wait() for run in runs])
+    entries = [e for e in os.listdir(cache_dir) if os.path.isdir(os.path.join(cache_dir, e))]
+    self.assertEqual(len(entries), 1)
+
+    # another run still mapping against the index mustn't hold this one up
+    lock = open(os.path.join(cache_dir, entries[0]+'.lock'), 'a')
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    # (without close_fds the run would share our lock)
+    run = subprocess.Popen(command, shell=True, close_fds=True)
+    started = time.time()
+    while run.poll() is None and time.time() - started < 60:
+      time.sleep(0.1)
+    lock.close()
+    self.assertEqual(run.wait(), 0)
+    self.assertTrue(time.time() - started < 60)
+    os.system('rm -r ' +cache_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+#=======================================================================
+# Author:
+#
+# Unit tests for sam2PairPlotCSV.py.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import sys
+import subprocess
+import tempfile
+import shutil
+import random
+import os
+import os.path
+import pysam
+
+data_dir = os.path.abspath('data/')
+path_to_script = os.path.abspath('../sam2PairPlotCSV.py')
+sys.path.insert(0, '..')
+from pairPlotStore import PairPlotStoreReader
+
+CONTIG_LENGTHS = [3000, 2500, 1800]
+
+#
+# A sorted, indexed BAM with the awkward cases in it: placed unmapped mates,
+# pairs split across contigs, duplicate pairs, mates starting at the same place
+# and reads without a mate
+#
+def makeAwkwardBam(bamFileName):
+  rand = random.Random(0)
+  header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+            'SQ': [{'SN': 'contig_%d' % i, 'LN': length} for (i, length) in enumerate(CONTIG_LENGTHS)]}
+  records = []
+
+  def add(name, flag, tid, pos, mtid, mpos, tlen, unmapped=False):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.query_sequence = 'A' * 50
+    read.flag = flag
+    read.reference_id = tid
+    read.reference_start = pos
+    read.next_reference_id = mtid
+    read.next_reference_start = mpos
+    read.template_length = tlen
+    read.query_qualities = pysam.qualitystring_to_array('I' * 50)
+    if not unmapped:
+      read.mapping_quality = 30
+      read.cigarstring = '50M'
+    records.append(read)
+
+  def addPair(name, tid, pos, mpos):
+    (rev, mrev) = (rand.random() < 0.5, rand.random() < 0.5)
+    tlen = max(pos, mpos) + 50 - min(pos, mpos)
+    add(name, 1 | 64 | (16 * rev) | (32 * mrev), tid, pos, tid, mpos, tlen if pos <= mpos else -tlen)
+    add(name, 1 | 128 | (16 * mrev) | (32 * rev), tid, mpos, tid, pos, -tlen if pos <= mpos else tlen)
+
+  for i in range(300):
+    name = 'pair%d' % i
+    tid = rand.randrange(len(CONTIG_LENGTHS))
+    pos = rand.randrange(0, CONTIG_LENGTHS[tid] - 500)
+    kind = rand.random()
+    if kind < 0.5:
+      addPair(name, tid, pos, pos + rand.randint(0, 400))
+      if kind < 0.1:
+        # PCR duplicates
+        for j in range(rand.randint(1, 3)):
+          addPair(name + '_dup%d' % j, tid, pos, records[-1].reference_start)
+    elif kind < 0.7:
+      # mate didn't map and has been placed next to this one (flags 73/133 or 89/165)
+      rev = rand.random() < 0.5
+      add(name, 1 | 8 | 64 | (16 * rev), tid, pos, tid, pos, 0)
+      add(name, 1 | 4 | 128 | (32 * rev), tid, pos, tid, pos, 0, unmapped=True)
+    elif kind < 0.9:
+      mtid = (tid + rand.randint(1, len(CONTIG_LENGTHS) - 1)) % len(CONTIG_LENGTHS)
+      mpos = rand.randrange(0, CONTIG_LENGTHS[mtid] - 50)
+      add(name, 1 | 64 | (16 * (rand.random() < 0.5)), tid, pos, mtid, mpos, 0)
+      add(name, 1 | 128 | (16 * (rand.random() < 0.5)), mtid, mpos, tid, pos, 0)
+    else:
+      add(name, 16 * (rand.random() < 0.5), tid, pos, -1, -1, 0)
+
+  records.sort(key=lambda read: (read.reference_id, read.reference_start))
+  bam = pysam.AlignmentFile(bamFileName, 'wb', header=header)
+  for read in records:
+    bam.write(read)
+  bam.close()
+  pysam.index(bamFileName)
+
+class Sam2PairPlotCSVTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.bams = [os.path.join(data_dir, 'reads12vRef.bam'), self.path('awkward.bam')]
+    makeAwkwardBam(self.bams[1])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def path(self, name):
+    return os.path.join(self.tmp_dir, name)
+
+  # run in a directory of its own and return { file name : contents } for everything written
+  def runScript(self, bamFileName, options):
+    out_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+    subprocess.check_call(path_to_script+' -s '+bamFileName+' -b '+options, shell=True, cwd=out_dir, stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    files = {}
+    for name in os.listdir(out_dir):
+      with open(os.path.join(out_dir, name)) as fh:
+        files[name] = fh.read()
+    return files
+
+  def readCSV(self, text):
+    return [[int(value) for value in line.split(',')] for line in text.split('\n')[1:] if line]
+
+  def testModesMatch(self):
+    for bam in self.bams:
+      for options in ['', '-c', '-f 0.5', '-c -f 0.5 --sample_seed 3']:
+        serial = self.runScript(bam, options)
+        self.assertTrue(len(serial) > 0)
+        self.assertEqual(serial, self.runScript(bam, options+' -S'), bam+' '+options)
+        self.assertEqual(serial, self.runScript(bam, options+' -P 3'), bam+' '+options)
+
+  def testStoreMatchesCSVs(self):
+    for bam in self.bams:
+      csvs = self.runScript(bam, '-c -S')
+      store_name = self.path('pairs.store')
+      self.runScript(bam, '-c -P 3 -z '+store_name)
+      store = PairPlotStoreReader(store_name)
+      contigs = [name[:-len('_map_out.csv')] for name in csvs if name.endswith('_map_out.csv')]
+      self.assertEqual(sorted(contigs), sorted(store.contigs()))
+      for con_id in contigs:
+        self.assertEqual(self.readCSV(csvs[con_id+'_map_out.csv']), [list(row) for row in zip(*store.loadPairs(con_id))])
+        (coverage, mode_coverage) = store.loadCoverage(con_id)
+        self.assertEqual(self.readCSV(csvs[con_id+'_map_out_coverage.csv']), [[i + 1, value] for (i, value) in enumerate(coverage)])
+        self.assertEqual(self.readCSV(csvs[con_id+'_map_out_mode_coverage.csv']), [[mode_coverage]])
+      store.close()
+
+  def testRegionsMatchWholeContigs(self):
+    whole = self.runScript(self.bams[1], '-c')
+    regions = [('contig_0', 1, 3000), ('contig_1', 400, 1300), ('contig_2', 901, 1800)]
+    options = ' '.join('-r %s:%d-%d' % region for region in regions)
+    # asking for the same region twice makes no difference
+    for got in [self.runScript(self.bams[1], options+' -c'), self.runScript(self.bams[1], options+' -r contig_1:400-1300 -c')]:
+      self.assertEqual(3 * len(regions), len(got))
+      for (con_id, start, end) in regions:
+        label = '%s_%d-%d' % (con_id, start, end)
+        # pair positions are 0 based, coverage positions are 1 based
+        expected = [row for row in self.readCSV(whole[con_id+'_map_out.csv']) if start <= row[0] + 1 <= end]
+        self.assertEqual(expected, self.readCSV(got[label+'_map_out.csv']))
+        expected = [row for row in self.readCSV(whole[con_id+'_map_out_coverage.csv']) if start <= row[0] <= end]
+        self.assertEqual(expected, self.readCSV(got[label+'_map_out_coverage.csv']))
+
+  def testSampling(self):
+    whole = self.runScript(self.bams[1], '')
+    self.assertEqual(whole, self.runScript(self.bams[1], '-f 1'))
+    half = self.runScript(self.bams[1], '-f 0.5')
+    self.assertTrue(sum(len(self.readCSV(text)) for text in half.values()) < sum(len(self.readCSV(text)) for text in whole.values()))
+    self.assertNotEqual(half, self.runScript(self.bams[1], '-f 0.5 --sample_seed 1'))
+    self.assertEqual(half, self.runScript(self.bams[1], '-f 0.5 --sample_seed 0'))
+
+
+if __name__ == "__main__":
+	unittest.main()
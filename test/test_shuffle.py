@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+#=======================================================================
+# Author:
+#
+# Unit tests for shuffle.py.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import sys
+import subprocess
+import tempfile
+import shutil
+import gzip
+import random
+import os.path
+from cStringIO import StringIO
+
+data_dir = 'data/'
+path_to_script = '../shuffle.py'
+sys.path.insert(0, '..')
+from shuffle import ContigParser
+
+# inputs where the block parser has to hand over to readfq or copy what it does
+AWKWARD_INPUTS = [
+  '',
+  '\n\n',
+  'junk\n@r1\nACGT\n+\nIIII\n',
+  '@r1\nACGT\n+\nIIII\n@r2\nAC\n+\nII',                  # no newline at the end
+  '@r1\nACGT\n+\nIIII\n@r2\nACGT\n+\nII\n',              # quality too short
+  '@r1\nACGT\n+\nIIII\n@r2\nAC',                          # cut off half way
+  '@r1\nAC\nGT\n+\nII\nII\n@r2\nACGT\n+\nIIII\n',         # wrapped
+  '@r1\nACGT\n+r1\nIIII\n@r2\n\n+\n\n',                   # + comment, empty read
+  '@r1/1\r\nACGT\r\n+\r\nIIII\r\n@r2/1\r\nAC\r\n+\r\nII\r\n',
+  '@r1 extra words\nACGT\n+\nIIII\n@r2\tmore\nAC\n+\nII\n',
+  '@r1\nACGT\n+\nIIII\n\n\n',
+  '>c1 desc\nACGT\nAC\n>c2\n\n>c3\nA\n',
+  '>c1\nACGT\nAC',                                        # fasta without a newline at the end
+  '>c1\r\nACGT\r\n>c2\r\nAC\r\n',
+  '>c1\nACGT\n@r1\nAC\n+\nII\n',                          # fastq after fasta
+  '>c1\nACGT\n+\nIIII\n>c2\nAC\n',
+]
+
+def randomInput(rand):
+  fastq = rand.random() < 0.5
+  records = []
+  for i in range(rand.randint(0, 6)):
+    name = rand.choice(['r%d' % i, 'r%d/1' % i, 'r%d x' % i])
+    seq = ''.join(rand.choice('ACGTN') for j in range(rand.randint(0, 9)))
+    if fastq:
+      records.append('@%s\n%s\n+\n%s\n' % (name, seq, 'I' * len(seq)))
+    else:
+      records.append('>%s\n%s\n' % (name, '\n'.join(seq[j:j+4] for j in range(0, len(seq), 4))))
+  text = ''.join(records)
+  if text and rand.random() < 0.3:
+    text = text[:rand.randint(0, len(text))]
+  if rand.random() < 0.2:
+    text = text.replace('\n', '\r\n')
+  return text
+
+def parse(parser, text):
+  try:
+    return list(parser(StringIO(text)))
+  except Exception as e:
+    return type(e).__name__
+
+def readGzipped(fileName):
+  fh = gzip.open(fileName)
+  data = fh.read()
+  fh.close()
+  return data
+
+class BlockParserTests(unittest.TestCase):
+  def assertMatchesReadfq(self, text):
+    expected = parse(ContigParser().readfq, text)
+    for block_size in [1, 2, 3, 5, 8, 13, 64]:
+      got = parse(lambda fp: ContigParser().readfqFast(fp, block_size), text)
+      self.assertEqual(expected, got, "block size %d: %r" % (block_size, text))
+
+  def testAwkwardInputs(self):
+    for text in AWKWARD_INPUTS:
+      self.assertMatchesReadfq(text)
+
+  def testRandomInputs(self):
+    rand = random.Random(0)
+    for i in range(500):
+      self.assertMatchesReadfq(randomInput(rand))
+
+  def testFixtures(self):
+    for name in ['reads.1.fq.gz', 'reads.2.fq.gz', 'reads.fq.gz']:
+      self.assertMatchesReadfq(readGzipped(data_dir+name))
+
+
+class ShuffleTests(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testRoundTrip(self):
+    for options in ['', '-t 2', '-B 1']:
+      shuffled = os.path.join(self.tmp_dir, 'shuffled.fq.gz')
+      forward = os.path.join(self.tmp_dir, 'reads.1.fq.gz')
+      reverse = os.path.join(self.tmp_dir, 'reads.2.fq.gz')
+      subprocess.check_call(path_to_script+' '+options+' -c data/reads.1.fq.gz data/reads.2.fq.gz '+shuffled, shell=True)
+      self.assertEqual(readGzipped(data_dir+'reads.fq.gz'), readGzipped(shuffled))
+      subprocess.check_call(path_to_script+' '+options+' -c -d '+forward+' '+reverse+' '+shuffled, shell=True)
+      self.assertEqual(readGzipped(data_dir+'reads.1.fq.gz'), readGzipped(forward))
+      self.assertEqual(readGzipped(data_dir+'reads.2.fq.gz'), readGzipped(reverse))
+
+  def testShardsHoldEveryPair(self):
+    shuffled = os.path.join(self.tmp_dir, 'shuffled.fq.gz')
+    subprocess.check_call(path_to_script+' -n 2 data/reads.1.fq.gz data/reads.2.fq.gz '+shuffled, shell=True)
+    shards = [readGzipped(os.path.join(self.tmp_dir, 'shuffled.%d.fq.gz' % i)) for i in range(2)]
+    pairs = readGzipped(data_dir+'reads.fq.gz').split('\n')
+    self.assertEqual('\n'.join(pairs[0:8]) + '\n', shards[0])
+    self.assertEqual('\n'.join(pairs[8:16]) + '\n', shards[1])
+
+  def testShortMateFileLeavesValidOutput(self):
+    short = os.path.join(self.tmp_dir, 'short.2.fq')
+    with open(short, 'w') as fh:
+      fh.write('\n'.join(readGzipped(data_dir+'reads.2.fq.gz').split('\n')[0:4]) + '\n')
+    for options in ['-t 2', '-t 2 -n 2']:
+      shuffled = os.path.join(self.tmp_dir, 'shuffled.fq.gz')
+      ret = subprocess.call(path_to_script+' '+options+' data/reads.1.fq.gz '+short+' '+shuffled+' >/dev/null', shell=True)
+      self.assertEqual(ret, 1)
+      written = ''
+      for name in sorted(os.listdir(self.tmp_dir)):
+        if name.startswith('shuffled'):
+          # gzip complains about truncated files
+          written += readGzipped(os.path.join(self.tmp_dir, name))
+          os.remove(os.path.join(self.tmp_dir, name))
+      self.assertEqual('\n'.join(readGzipped(data_dir+'reads.fq.gz').split('\n')[0:8]) + '\n', written)
+
+
+if __name__ == "__main__":
+	unittest.main()